@@ -12,6 +12,7 @@ import os
 import pickle
 import random
 import re
+import signal
 import sys
 import tempfile
 import textwrap
@@ -32,19 +33,33 @@ import discord
 from discord.ext import commands
 
 from dobby.exts.db.dobbydb import *
-DobbyDB.start('data/dobby.db')
 
-
-from dobby import checks, configuration, utils, constants
+from dobby import checks, configuration, utils, constants, export, locimport
 from dobby.bot import DobbyBot
 from dobby.errors import custom_error_handling
+from dobby.exts.db.backup import OnlineBackup
+from dobby.exts.db.maintenance import MaintenanceScheduler
 from dobby.logs import init_loggers
+from dobby.reports import ReportIngestor
+from dobby.storage import CODECS, DatabaseGuildStore, GuildDict, GuildJournal, GuildSnapshotStore, benchmark_codecs
 
 logger = init_loggers()
 _ = gettext.gettext
 
-def _get_prefix(bot, message):
+_promoted = False
+
+def _promote(signum, frame):
+    global _promoted
+    _promoted = True
+
+if 'standby' in sys.argv[1:]:
+    signal.signal(signal.SIGUSR1, _promote)
+
+async def _get_prefix(bot, message):
     guild = message.guild
+    if guild is not None:
+        # every command looks up its guild's config, read it off the event loop first
+        await bot.guild_dict.preload([guild.id])
     try:
         prefix = bot.guild_dict[guild.id]['configure_dict']['settings']['prefix']
     except (KeyError, AttributeError):
@@ -63,28 +78,6 @@ Dobby.empty_str = '\u200b'
 
 custom_error_handling(Dobby, logger)
 
-def _load_data(bot):
-    try:
-        with open(os.path.join('data', 'serverdict'), 'rb') as fd:
-            bot.guild_dict = pickle.load(fd)
-        logger.info('Serverdict Loaded Successfully')
-    except OSError:
-        logger.info('Serverdict Not Found - Looking for Backup')
-        try:
-            with open(os.path.join('data', 'serverdict_backup'), 'rb') as fd:
-                bot.guild_dict = pickle.load(fd)
-            logger.info('Serverdict Backup Loaded Successfully')
-        except OSError:
-            logger.info('Serverdict Backup Not Found - Creating New Serverdict')
-            bot.guild_dict = {}
-            with open(os.path.join('data', 'serverdict'), 'wb') as fd:
-                pickle.dump(bot.guild_dict, fd, -1)
-            logger.info('Serverdict Created')
-
-_load_data(Dobby)
-
-guild_dict = Dobby.guild_dict
-
 config = {}
 
 """
@@ -101,7 +94,54 @@ load_config()
 
 Dobby.config = config
 
-default_exts = ['utilities', 'locationmatching', 'eventcommands', 'badges']
+# the launcher only starts a standby once the primary is ready, schema and default data are already in place
+DobbyDB.start('data/dobby.db', partitions=config.get('db_partitions', 0),
+              partition_map=config.get('db_partition_map'), migrate='standby' not in sys.argv[1:])
+
+def _guild_store(bot):
+    snapshots = GuildSnapshotStore(os.path.join('data', 'guilds'),
+                                   legacy_path=os.path.join('data', 'serverdict'),
+                                   codec=CODECS[bot.config.get('snapshot_codec', 'pickle')],
+                                   generations=bot.config.get('snapshot_generations', 3))
+    if bot.config.get('guild_storage', 'database') == 'snapshot':
+        return snapshots
+    return DatabaseGuildStore(fallback=snapshots)
+
+DobbyDB.profiler.threshold = config.get('slow_query_ms', 100) / 1000
+DobbyDB.profiler.enabled = config.get('query_profiling', True)
+
+Dobby.guild_store = _guild_store(Dobby)
+Dobby.report_ingestor = ReportIngestor(interval=config.get('report_flush_ms', 250) / 1000,
+                                       dedupe_window=config.get('report_dedupe_seconds', 300),
+                                       max_batch=config.get('report_batch_max', 1000))
+Dobby.db_backup = OnlineBackup(os.path.join('data', 'backups'), keep=config.get('backup_keep', 8),
+                               pages=config.get('backup_step_pages', 100))
+Dobby.db_maintenance = MaintenanceScheduler(quiet_jobs=config.get('maintenance_quiet_jobs', 20),
+                                            vacuum_pages=config.get('maintenance_vacuum_pages', 256),
+                                            analysis_limit=config.get('maintenance_analysis_limit', 1000),
+                                            wal_limit=config.get('maintenance_wal_limit_mb', 64) * 1024 * 1024)
+
+def _load_data(bot):
+    migrated = 0
+    if 'standby' not in sys.argv[1:]:
+        # the primary owns migration, a standby only reads what it wrote
+        migrated = bot.guild_store.migrate_legacy()
+    if migrated:
+        logger.info(f'Legacy Serverdict migrated for {migrated} guilds')
+    journal = None
+    if not bot.guild_store.write_through:
+        journal = GuildJournal(os.path.join(bot.guild_store.path, 'journal'), codec=bot.guild_store.codec)
+    bot.guild_dict = GuildDict(store=bot.guild_store, journal=journal, defaults=constants.DEFAULT_GUILD)
+    replayed = bot.guild_dict.replay_journal()
+    if replayed:
+        logger.info(f'Serverdict Journal Replayed ({replayed} changes)')
+    logger.info(f'Serverdict Index Loaded Successfully ({len(bot.guild_dict)} guilds)')
+
+_load_data(Dobby)
+
+guild_dict = Dobby.guild_dict
+
+default_exts = ['utilities', 'locationmatching', 'eventcommands', 'badges', 'leaderboards']
 
 for ext in default_exts:
     try:
@@ -112,6 +152,11 @@ for ext in default_exts:
         if 'debug' in sys.argv[1:]:
             print(f'Loaded {ext} extension.')
 
+# the hot lookups are registered as the extensions load, make sure none of them regressed to a full scan
+with DobbyDB._db.routed(DobbyDB.partitions[0].database if DobbyDB.partitions else None):
+    for name, detail in DobbyDB.queries.full_scans():
+        logger.warning(f'Query {name} reads a whole table: {detail}')
+
 @Dobby.command(name='load')
 @checks.is_owner()
 async def _load(ctx, *extensions):
@@ -169,7 +214,7 @@ async def fortress(ctx, *, name):
     message = ctx.message
     channel = ctx.channel
     guild = ctx.guild
-    fortresses = get_fortresses(guild.id)
+    fortresses = await get_fortresses(guild.id)
     fortress = await location_match_prompt(channel, message.author.id, name, fortresses)
     if not fortress:
         return await channel.send(embed=discord.Embed(colour=discord.Colour.red(), description=f"No fortress found with name '{name}'. Try again using the exact fortress name!"))
@@ -179,20 +224,27 @@ async def fortress(ctx, *, name):
         fortress_embed.add_field(name=_('**Fortress Information**'), value=fortress_info, inline=False)
         return await channel.send(content="", embed=fortress_embed)
 
-def get_fortresses(guild_id, regions=None):
+async def get_fortresses(guild_id, regions=None):
     location_matching_cog = Dobby.cogs.get('LocationMatching')
     if not location_matching_cog:
         return None
-    fortress = location_matching_cog.get_fortresses(guild_id, regions)
+    fortress = await location_matching_cog.get_fortresses(guild_id, regions)
     return fortress
 
+async def get_inns(guild_id, regions=None):
+    location_matching_cog = Dobby.cogs.get('LocationMatching')
+    if not location_matching_cog:
+        return None
+    inn = await location_matching_cog.get_inns(guild_id, regions)
+    return inn
+
 @Dobby.command(name='greenhouse', aliases=['gh'])
 async def greenhouse(ctx, *, name):
     '''Lookup directions to a Greenhouse'''
     message = ctx.message
     channel = ctx.channel
     guild = ctx.guild
-    greenhouses = get_greenhouses(guild.id)
+    greenhouses = await get_greenhouses(guild.id)
     greenhouse = await location_match_prompt(channel, message.author.id, name, greenhouses)
     if not greenhouse:
         return await channel.send(embed=discord.Embed(colour=discord.Colour.red(), description=f"No greenhouse found with name '{name}'. Try again using the exact greenhouse name!"))
@@ -202,18 +254,81 @@ async def greenhouse(ctx, *, name):
         greenhouse_embed.add_field(name=_('**Fortress Information**'), value=greenhouse_info, inline=False)
         return await channel.send(content="", embed=greenhouse_embed)
 
-def get_greenhouses(guild_id, regions=None):
+async def get_greenhouses(guild_id, regions=None):
     location_matching_cog = Dobby.cogs.get('LocationMatching')
     if not location_matching_cog:
         return None
-    greenhouse = location_matching_cog.get_greenhouses(guild_id, regions)
+    greenhouse = await location_matching_cog.get_greenhouses(guild_id, regions)
     return greenhouse
 
+@Dobby.command(name='nearby', aliases=['near'])
+async def nearby(ctx, *, info):
+    """Lists the locations closest to a point or to another location.
+
+    Usage: !nearby <latitude,longitude | location name> [fortress/inn/greenhouse] [count]"""
+    channel = ctx.channel
+    words = info.split()
+    k = 5
+    type = None
+    if len(words) > 1 and words[-1].isdigit():
+        k = max(1, min(int(words.pop()), 25))
+    if len(words) > 1 and words[-1].lower() in LocationLoader.type_tables:
+        type = words.pop().lower()
+    origin = ' '.join(words)
+    origin_id = None
+    coordinates = re.fullmatch(r'\s*(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)\s*', origin)
+    if coordinates:
+        latitude, longitude = float(coordinates.group(1)), float(coordinates.group(2))
+    else:
+        location_matching_cog = Dobby.cogs.get('LocationMatching')
+        if not location_matching_cog:
+            return await channel.send('Location matching has not been set up for this server.')
+        locations = await location_matching_cog.get_all(ctx.guild.id)
+        location = await location_match_prompt(channel, ctx.author.id, origin, locations)
+        if not location:
+            return await channel.send(embed=discord.Embed(colour=discord.Colour.red(), description=f"No location found with name '{origin}'."))
+        latitude, longitude, origin_id = location.latitude, location.longitude, location.id
+    results = await DobbyDB.guild(ctx.guild.id).read(LocationTable.nearby, ctx.guild.id, latitude, longitude, type, k + 1)
+    results = [r for r in results if r[0].id != origin_id][:k]
+    if not results:
+        return await channel.send(embed=discord.Embed(colour=discord.Colour.red(), description="No locations found."))
+    lines = [f"**{location.name}** ({location_type}) - {distance:.2f} km [map]({simple_gmaps_query(location.latitude, location.longitude)})"
+             for location, location_type, distance in results]
+    embed = discord.Embed(title=_('Closest {type}s to {origin}').format(type=type or 'location', origin=origin),
+                          colour=ctx.guild.me.colour, description='\n'.join(lines))
+    await channel.send(embed=embed)
+
+@Dobby.command(name='report')
+async def report(ctx, type, *, name):
+    """Reports activity at a location.
+
+    Usage: !report <fortress/inn/greenhouse> <location name>
+    Repeat reports of the same location by the same wizard are ignored for a few minutes."""
+    channel = ctx.channel
+    type = type.lower()
+    lookups = {'fortress': get_fortresses, 'fort': get_fortresses, 'inn': get_inns,
+               'greenhouse': get_greenhouses, 'gh': get_greenhouses}
+    if type not in lookups:
+        return await channel.send(embed=discord.Embed(colour=discord.Colour.red(), description="Report type must be fortress, inn or greenhouse."))
+    locations = await lookups[type](ctx.guild.id)
+    if not locations:
+        return await channel.send('Location matching has not been set up for this server.')
+    location = await location_match_prompt(channel, ctx.author.id, name, locations)
+    if not location:
+        return await channel.send(embed=discord.Embed(colour=discord.Colour.red(), description=f"No {type} found with name '{name}'."))
+    if Dobby.report_ingestor.submit(ctx.guild.id, ctx.author.id, location.id):
+        await ctx.message.add_reaction(Dobby.success_react)
+    else:
+        await ctx.message.add_reaction(Dobby.failed_react)
+
 async def location_match_prompt(channel, author_id, name, locations):
     # note: the following logic assumes json constraints -- no duplicates in source data
     location_matching_cog = Dobby.cogs.get('LocationMatching')
     match = None
-    result = location_matching_cog.location_match(name, locations)
+    shortlist = await location_matching_cog.shortlist(channel.guild.id, name, locations)
+    result = location_matching_cog.location_match(name, shortlist)
+    if not result and len(shortlist) < len(locations):
+        result = location_matching_cog.location_match(name, locations)
     results = [(match.name, score) for match, score in result]
     match = await prompt_match_result(channel, author_id, name, results)
     return next((l for l in locations if l.name == match), None)
@@ -248,29 +363,64 @@ async def _print(owner, message):
     logger.info(message)
 
 async def server_dict_save(Loop=True):
+    compact_bytes = config.get('journal_compact_bytes', 1024 * 1024)
     while (not Dobby.is_closed()):
-        guilddict_chtemp = copy.deepcopy(guild_dict)
-        logger.info('Scheduled Server Dict Save ------ BEGIN ------')
-        for guildid in guilddict_chtemp.keys():
-            try:
-                await _save(guildid)
-                logger.info(f'Server Dict successfully save for guild with id: {guildid}')
-            except Exception as err:
-                logger.info('Scheduled Server Dict Save - SAVING FAILED' + str(err))
-        logger.info('Scheduled Server Dict Save ------ END ------')
-        await asyncio.sleep(600)
+        if guild_dict.journal is None:
+            # database mode writes through, only guilds whose write failed are left to retry
+            if guild_dict.dirty:
+                saved, skipped = await guild_dict.flush(event_loop)
+                logger.info(f'Server Dict Save - {saved} guilds retried')
+        elif guild_dict.journal.size >= compact_bytes:
+            logger.info('Scheduled Server Dict Save ------ BEGIN ------')
+            journal_size = guild_dict.journal.size
+            saved, skipped = await guild_dict.flush(event_loop)
+            logger.info(f'Scheduled Server Dict Save - {saved} guilds saved, {skipped} unchanged guilds skipped, '
+                        f'{journal_size} journal bytes compacted, loop paused {guild_dict.stats.last_pause * 1000:.2f}ms')
+            logger.info('Scheduled Server Dict Save ------ END ------')
+        await asyncio.sleep(60)
         continue
 
+_maint_started = False
+
 async def maint_start():
+    # on_ready fires again after every reconnect, the loops must only be started once
+    global _maint_started
+    if _maint_started:
+        return
+    _maint_started = True
     tasks = []
     try:
         tasks.append(event_loop.create_task(server_dict_save()))
+        tasks.append(event_loop.create_task(Dobby.report_ingestor.run()))
+        tasks.append(event_loop.create_task(Dobby.db_maintenance.run()))
+        if config.get('backup_interval_hours', 6):
+            tasks.append(event_loop.create_task(Dobby.db_backup.run(config.get('backup_interval_hours', 6) * 3600)))
         logger.info('Maintenance Tasks Started')
     except KeyboardInterrupt:
         [task.cancel() for task in tasks]
 
 event_loop = asyncio.get_event_loop()
 
+async def _standby():
+    """Keeps guild state current until the launcher promotes this process.
+
+    In snapshot mode the primary's journal is tailed, in database mode the
+    guild index is reread so the connection and page cache stay warm."""
+    logger.info('Standing by for promotion')
+    while not _promoted:
+        if guild_dict.journal is not None:
+            guild_dict.follow_journal()
+        else:
+            await guild_dict.invalidate()
+        await asyncio.sleep(config.get('standby_poll_seconds', 0.5))
+    if guild_dict.journal is not None:
+        followed = guild_dict.follow_journal()
+        guild_dict.journal.reopen()
+        logger.info(f'Promoted from standby, {followed} final journal changes applied')
+    else:
+        await guild_dict.invalidate()
+        logger.info('Promoted from standby')
+
 """
 Events
 """
@@ -285,32 +435,12 @@ async def on_ready():
     msg_fail = 0
     guilds = len(Dobby.guilds)
     users = 0
+    loaded = await guild_dict.preload([guild.id for guild in Dobby.guilds])
+    logger.info(f'Serverdict Preloaded ({loaded} guilds)')
     for guild in Dobby.guilds:
         users += len(guild.members)
-        try:
-            if guild.id not in guild_dict:
-                guild_dict[guild.id] = {
-                    'configure_dict':{
-                        'welcome': {'enabled':False,'welcomechan':'','welcomemsg':''},
-                        'invite': {'enabled':False},
-                        'house':{'enabled':False, 'sort_channels': []},
-                        'profession':{'enabled':False, 'sort_channels': []},
-                        'settings':{'offset':0,'regional':None,'done':False,'prefix':None,'config_sessions':{}}
-                    },
-                    'wizards':{}
-                }
-            else:
-                pass
-        except KeyError:
-            guild_dict[guild.id] = {
-                'configure_dict':{
-                    'welcome': {'enabled':False,'welcomechan':'','welcomemsg':''},
-                    'invite': {'enabled':False},
-                    'profession':{'enabled':False, 'sort_channels': []},
-                    'settings':{'offset':0,'regional':None,'done':False,'prefix':None,'config_sessions':{}}
-                },
-                'wizards':{}
-            }
+        if guild.id not in guild_dict:
+            guild_dict[guild.id] = {}
         owners.append(guild.owner)
     await _print(Dobby.owner, _("{server_count} servers connected.\n{member_count} members found.").format(server_count=guilds, member_count=users))
     await maint_start()
@@ -318,15 +448,7 @@ async def on_ready():
 @Dobby.event
 async def on_guild_join(guild):
     owner = guild.owner
-    guild_dict[guild.id] = {
-        'configure_dict':{
-            'welcome': {'enabled':False,'welcomechan':'','welcomemsg':''},
-            'invite': {'enabled':False},
-            'profession':{'enabled':False, 'sort_channels': []},
-            'settings':{'offset':0,'regional':None,'done':False,'prefix':None,'config_sessions':{}}
-        },
-        'wizards':{}
-    }
+    guild_dict[guild.id] = {}
     await owner.send(_("I'm Dobby, a Discord helper bot for Wizards Unite communities, and someone has invited me to your server! Type **!help** to see a list of things I can do, and type **!configure** in any channel of your server to begin!"))
 
 @Dobby.event
@@ -498,26 +620,17 @@ async def save(ctx):
     Usage: !save
     File path is relative to current directory."""
     try:
-        await _save(ctx.guild.id)
+        await _save_all()
         logger.info('CONFIG SAVED')
     except Exception as err:
         await _print(Dobby.owner, _('Error occured while trying to save!'))
         await _print(Dobby.owner, err)
 
-async def _save(guildid):
-    with tempfile.NamedTemporaryFile('wb', dir=os.path.dirname(os.path.join('data', 'serverdict')), delete=False) as tf:
-        pickle.dump(guild_dict, tf, -1)
-        tempname = tf.name
-    try:
-        os.remove(os.path.join('data', 'serverdict_backup'))
-    except OSError as e:
-        pass
-    try:
-        os.rename(os.path.join('data', 'serverdict'), os.path.join('data', 'serverdict_backup'))
-    except OSError as e:
-        if e.errno != errno.ENOENT:
-            raise
-    os.rename(tempname, os.path.join('data', 'serverdict'))
+async def _save_all():
+    saved, skipped = await guild_dict.flush(event_loop)
+    logger.info(f'Server Dict Save - {saved} guilds saved, {skipped} unchanged guilds skipped')
+    reports = await Dobby.report_ingestor.flush()
+    logger.info(f'Report Save - {reports} queued reports written')
 
     location_matching_cog = Dobby.cogs.get('LocationMatching')
     if not location_matching_cog:
@@ -525,6 +638,177 @@ async def _save(guildid):
         return None
 
 
+@Dobby.command(hidden=True)
+@checks.is_owner()
+async def savestats(ctx):
+    """Shows how long guild data saves block Dobby.
+
+    Usage: !savestats"""
+    stats = guild_dict.stats
+    msg = _("**Guilds Loaded:** {loaded}/{total}\n**Saves:** {snapshots}\n**Guilds Written:** {guilds}\n**Pending:** {pending}\n"
+            "**Loop Pause:** {last:.2f}ms last, {avg:.2f}ms avg, {max:.2f}ms max\n"
+            "**Last Write:** {write:.2f}ms").format(
+        loaded=guild_dict.loaded, total=len(guild_dict),
+        snapshots=stats.snapshots, guilds=stats.guilds_written, pending=len(guild_dict.dirty),
+        last=stats.last_pause * 1000, avg=stats.average_pause * 1000,
+        max=stats.max_pause * 1000, write=stats.last_write * 1000)
+    if guild_dict.journal is not None:
+        msg += _("\n**Journal:** {size} bytes").format(size=guild_dict.journal.size)
+    await ctx.send(embed=discord.Embed(colour=discord.Colour.lighter_grey(), description=msg))
+
+@Dobby.command(hidden=True)
+@checks.is_owner()
+async def dbqueue(ctx):
+    """Shows how much work is waiting on the database threads.
+
+    Usage: !dbqueue"""
+    embed = discord.Embed(colour=discord.Colour.lighter_grey())
+    queues = [('Writer', DobbyDB.stats), ('Readers', DobbyDB.read_stats)]
+    for partition in DobbyDB.partitions:
+        queues += [(f'Partition {partition.index} Writer', partition.stats),
+                   (f'Partition {partition.index} Readers', partition.read_stats)]
+    for name, stats in queues:
+        value = _("**Queued:** {depth} now, {max_depth} max\n**Completed:** {completed} ({failed} failed)\n"
+                  "**Wait:** {avg_wait:.2f}ms avg, {max_wait:.2f}ms max\n"
+                  "**Run:** {avg_run:.2f}ms avg, {max_run:.2f}ms max").format(
+            depth=stats.depth, max_depth=stats.max_depth, completed=stats.completed, failed=stats.failed,
+            avg_wait=stats.average_wait * 1000, max_wait=stats.max_wait * 1000,
+            avg_run=stats.average_run * 1000, max_run=stats.max_run * 1000)
+        embed.add_field(name=name, value=value, inline=False)
+    await ctx.send(embed=embed)
+
+@Dobby.command(hidden=True)
+@checks.is_owner()
+async def reportstats(ctx):
+    """Shows how far report writes lag behind the reports.
+
+    Usage: !reportstats"""
+    ingestor = Dobby.report_ingestor
+    stats = ingestor.stats
+    msg = _("**Accepted:** {accepted} ({duplicates} duplicates dropped)\n**Pending:** {pending}\n"
+            "**Written:** {written} in {batches} batches ({failed} failed)\n"
+            "**Rejected:** {rejected} ({dropped} dropped after retries)\n"
+            "**Batch Size:** {last} last, {avg:.1f} avg, {max} max\n"
+            "**Lag:** {last_lag:.2f}ms last, {avg_lag:.2f}ms avg, {max_lag:.2f}ms max").format(
+        accepted=stats.accepted, duplicates=stats.duplicates, pending=ingestor.pending,
+        written=stats.written, batches=stats.batches, failed=stats.failed_batches,
+        rejected=stats.rejected, dropped=stats.dropped,
+        last=stats.last_batch, avg=stats.average_batch, max=stats.max_batch,
+        last_lag=stats.last_lag * 1000, avg_lag=stats.average_lag * 1000, max_lag=stats.max_lag * 1000)
+    await ctx.send(embed=discord.Embed(colour=discord.Colour.lighter_grey(), description=msg))
+
+@Dobby.command(hidden=True)
+@checks.is_owner()
+async def backup(ctx):
+    """Backs up the database now without pausing Dobby.
+
+    Usage: !backup"""
+    if Dobby.db_backup.running:
+        return await ctx.send(_("A backup is already running."))
+    result = await Dobby.db_backup.backup()
+    msg = _("**Files:** {paths}\n**Pages:** {pages} in {duration:.2f}s ({rate:.0f} pages/s)\n"
+            "**Longest Step:** {step:.2f}ms\n**Kept:** {kept}").format(
+        paths=', '.join(os.path.basename(path) for path in result.paths), pages=result.pages, duration=result.duration,
+        rate=result.pages_per_second, step=result.max_step * 1000, kept=len(Dobby.db_backup.backups()))
+    await ctx.send(embed=discord.Embed(colour=discord.Colour.lighter_grey(), description=msg))
+
+@Dobby.command(hidden=True)
+@checks.is_owner()
+async def dbmaint(ctx, task=None):
+    """Shows database maintenance metrics or runs a maintenance task now.
+
+    Usage: !dbmaint [checkpoint/optimize/vacuum/fullvacuum]
+    fullvacuum rewrites the whole database and blocks writes while it runs, it is
+    only needed once to turn on incremental vacuum for a database created before it."""
+    maintenance = Dobby.db_maintenance
+    if task == 'fullvacuum':
+        elapsed = await maintenance.full_vacuum()
+        return await ctx.send(_("Database rewritten in {elapsed:.2f}s.").format(elapsed=elapsed))
+    if task in maintenance.tasks:
+        result = await maintenance.run_task(task)
+        return await ctx.send(_("**{task}:** {result}").format(task=task, result=result))
+    embed = discord.Embed(colour=discord.Colour.lighter_grey(),
+                          description=_("**Ticks:** {ticks} ({busy} busy)\n**WAL:** {wal:.1f}MB").format(
+                              ticks=maintenance.ticks, busy=maintenance.busy_ticks, wal=maintenance.wal_size / 1024 / 1024))
+    for name, stats in maintenance.tasks.items():
+        value = _("**Runs:** {runs} ({failed} failed)\n**Time:** {last:.1f}ms last, {max:.1f}ms max\n"
+                  "**Last Result:** {result}").format(
+            runs=stats.runs, failed=stats.failed, last=stats.last_time * 1000, max=stats.max_time * 1000,
+            result=stats.last_result or 'never run')
+        embed.add_field(name=name.title(), value=value, inline=False)
+    await ctx.send(embed=embed)
+
+@Dobby.command(hidden=True)
+@checks.is_owner()
+async def dbstats(ctx, option=None):
+    """Shows where database time goes, per query shape.
+
+    Usage: !dbstats [dump/reset]
+    dump attaches every shape's counts, latency histogram and last slow plan as JSON."""
+    profiler = DobbyDB.profiler
+    if option == 'reset':
+        profiler.reset()
+        return await ctx.message.add_reaction(Dobby.success_react)
+    if option == 'dump':
+        dump = io.BytesIO(profiler.dump().encode('utf-8'))
+        return await ctx.send(file=discord.File(dump, filename='dbstats.json'))
+    shapes = profiler.snapshot()
+    lines = [f"{'calls':>7}{'total ms':>10}{'avg ms':>8}{'p95 ms':>8}{'max ms':>8}{'slow':>6}  query"]
+    for stats in shapes[:15]:
+        lines.append(f"{stats['count']:>7}{stats['total_ms']:>10.1f}{stats['avg_ms']:>8.2f}{stats['p95_ms']:>8.1f}"
+                     f"{stats['max_ms']:>8.1f}{stats['slow']:>6}  {textwrap.shorten(stats['shape'], 60)}")
+    await ctx.send(_("{count} query shapes since {since}, slow threshold {threshold:.0f}ms").format(
+        count=len(shapes), since=profiler.since.strftime('%Y-%m-%d %H:%M'), threshold=profiler.threshold * 1000))
+    output = "\n".join(lines)
+    for i in range(len(output) // 1990 + 1):
+        await ctx.send("```" + output[1990*i:1990*(i+1)] + "```")
+
+@Dobby.command(hidden=True)
+@checks.is_owner()
+async def querystats(ctx):
+    """Shows time spent generating versus executing the cached lookup queries.
+
+    Usage: !querystats"""
+    lines = [f"{'template':<24}{'calls':>8}{'gen ms':>9}{'exec ms':>9}{'saved ms':>10}"]
+    for name, calls, generate, execute, saved in sorted(DobbyDB.queries.stats(), key=lambda t: -t[1]):
+        lines.append(f"{name:<24}{calls:>8}{generate * 1000:>9.2f}{execute * 1000:>9.2f}{saved * 1000:>10.1f}")
+    await ctx.send("```" + "\n".join(lines) + "```")
+
+@Dobby.command(hidden=True)
+@checks.is_owner()
+async def queryplans(ctx):
+    """Shows the query plan of every cached lookup query.
+
+    Usage: !queryplans
+    Plan steps that read a whole table are marked with !!."""
+    # the guild data tables the templates read are only in the partitions when partitioned
+    database = DobbyDB.handles()[0]
+    scans = set(await database.read(DobbyDB.queries.full_scans))
+    lines = []
+    for name in DobbyDB.queries.templates:
+        lines.append(name)
+        for detail in await database.read(DobbyDB.queries.explain, name):
+            lines.append(f"{'!!' if (name, detail) in scans else '  '} {detail}")
+    output = "\n".join(lines)
+    for i in range(len(output) // 1990 + 1):
+        await ctx.send("```" + output[1990*i:1990*(i+1)] + "```")
+
+@Dobby.command(hidden=True)
+@checks.is_owner()
+async def codecbench(ctx):
+    """Benchmarks the snapshot codecs against the current guild data.
+
+    Usage: !codecbench
+    Every stored guild is loaded and encoded the way snapshots are written."""
+    guilds = {guildid: copy.deepcopy(guild_dict.overrides(guildid)) for guildid in guild_dict}
+    results = await event_loop.run_in_executor(None, benchmark_codecs, guilds)
+    current = getattr(Dobby.guild_store, 'codec', None)
+    lines = [f"{'codec':<10} {'encode':>10} {'decode':>10} {'size':>10}"]
+    for name, encode_time, decode_time, size in results:
+        marker = ' *' if current and current.name == name else ''
+        lines.append(f"{name:<10} {encode_time * 1000:>8.2f}ms {decode_time * 1000:>8.2f}ms {size / 1024:>8.1f}KB{marker}")
+    await ctx.send(_("Snapshot codecs for {count} guilds:").format(count=len(guilds)) + "\n```\n" + "\n".join(lines) + "\n```")
+
 @Dobby.command()
 @checks.is_owner()
 async def restart(ctx):
@@ -533,7 +817,7 @@ async def restart(ctx):
     Usage: !restart.
     Calls the save function and restarts Dobby."""
     try:
-        await _save(ctx.guild.id)
+        await _save_all()
     except Exception as err:
         await _print(Dobby.owner, _('Error occured while trying to save!'))
         await _print(Dobby.owner, err)
@@ -549,7 +833,7 @@ async def exit(ctx):
     Usage: !exit.
     Calls the save function and quits the script."""
     try:
-        await _save(ctx.guild.id)
+        await _save_all()
     except Exception as err:
         await _print(Dobby.owner, _('Error occured while trying to save!'))
         await _print(Dobby.owner, err)
@@ -625,7 +909,7 @@ async def profile(ctx):
     match = ''
     result = TitleTable.select(TitleTable.name)
     result = result.objects(Title)
-    results = [o for o in result]
+    results = await DobbyDB.read(list, result)
     titles = [r.name for r in results]
     prompt = "Choose a title (You can choose 3 total)" 
     while len(profile["titles"]) < 3:
@@ -635,7 +919,7 @@ async def profile(ctx):
         else:
             profile["titles"].append(match)
 
-    with DobbyDB._db.atomic():
+    def save_profile():
         wizard, __  = WizardTable.get_or_create(snowflake=author.id, guild=guild.id)
         wizardprofile, __  = ProfileTable.get_or_create(wizard_id=wizard)
         wizardprofile.wizardname = profile["name"]
@@ -644,6 +928,7 @@ async def profile(ctx):
         wizardprofile.title_two = profile["titles"][1] if len(profile["titles"]) > 1 else ""
         wizardprofile.title_three = profile["titles"][2] if len(profile["titles"]) > 2 else ""
         wizardprofile.save()
+    await DobbyDB.transaction(save_profile)
     await author.send("Profile Updated Successfully!")
 
 async def profile_step(text, ctx):
@@ -672,7 +957,7 @@ async def _get(ctx):
 @commands.has_permissions(manage_guild=True)
 async def prefix(ctx):
     """Get server prefix."""
-    prefix = _get_prefix(Dobby, ctx.message)
+    prefix = await _get_prefix(Dobby, ctx.message)
     await ctx.channel.send(_('Prefix for this server is: `{}`').format(prefix))
 
 @_get.command()
@@ -763,6 +1048,32 @@ async def outputlog(ctx):
                 reply = "https://hastebin.com/{}".format(post['key'])
     await ctx.channel.send(reply)
 
+@Dobby.command(name='export')
+@commands.has_permissions(manage_guild=True)
+async def _export(ctx, format='jsonl'):
+    """Exports this server's data as a compressed archive.
+
+    Usage: !export [jsonl/csv]
+    Locations, regions, notes, events, badges and profiles are read a chunk at a time into a gzipped
+    JSON lines file, or a zip with one csv per table. The locations csv can be loaded with !loc import."""
+    format = format.lower()
+    if format not in export.EXPORT_FORMATS:
+        return await ctx.send("Usage: `!export [jsonl/csv]`", delete_after=10)
+    exporter = export.GuildExport(ctx.guild.id, format, chunk_rows=config.get('export_chunk_rows', 1000))
+    status = await ctx.send(f"Exporting this server's data as {format}...")
+    with tempfile.TemporaryFile() as fd:
+        await exporter.write(DobbyDB.guild(ctx.guild.id), fd)
+        size = fd.tell()
+        logger.info(f'Exported {exporter.total_rows} rows for guild {ctx.guild.id} in {exporter.chunks} chunks, '
+                    f'{size} bytes in {exporter.elapsed:.2f}s')
+        if size > config.get('export_max_mb', 8) * 1024 * 1024:
+            return await status.edit(content=f"The export is {size / (1024 * 1024):.1f}MB, "
+                                             f"too large to upload as an attachment.")
+        fd.seek(0)
+        summary = ', '.join(f'{count} {name}' for name, count in exporter.rows.items())
+        await ctx.send(f"Exported {summary}.", file=discord.File(fd, filename=exporter.filename))
+    await status.delete()
+
 @Dobby.command(aliases=['say'])
 @commands.has_permissions(manage_guild=True)
 async def announce(ctx, *, announce=None):
@@ -1318,8 +1629,13 @@ async def profile(ctx, user: discord.Member = None):
     Usage:!profile [user]"""
     if not user:
         user = ctx.message.author
-    wizard, __  = WizardTable.get_or_create(snowflake=user.id, guild=ctx.guild.id)
-    wizardprofile, __  = ProfileTable.get_or_create(wizard_id=wizard)
+    def get_profile():
+        wizard = DobbyDB.queries.first('wizard', snowflake=user.id, guild=ctx.guild.id)
+        if wizard is None:
+            wizard, __  = WizardTable.get_or_create(snowflake=user.id, guild=ctx.guild.id)
+        wizardprofile, __  = ProfileTable.get_or_create(wizard_id=wizard)
+        return wizardprofile
+    wizardprofile = await DobbyDB.transaction(get_profile)
     embed = discord.Embed(title=_("{user}\'s Wizard Profile").format(user=user.display_name), colour=user.colour)
     embed.set_thumbnail(url=user.avatar_url)
     await ctx.send(embed=embed)
@@ -1397,7 +1713,7 @@ async def _loc_add(ctx, *, info):
     data["coordinates"] = f"{latitude},{longitude}"
     data["region"] = region.lower()
     data["guild"] = str(ctx.guild.id)
-    error_msg = LocationTable.create_location(name, data, type)
+    error_msg = await DobbyDB.guild(ctx.guild.id).run(LocationTable.create_location, name, data, type)
     if error_msg is None:
         success = await channel.send(embed=discord.Embed(colour=discord.Colour.green(), description=f"Successfully added {type}: {name}."))
         await message.add_reaction('✅')
@@ -1411,6 +1727,76 @@ async def _loc_add(ctx, *, info):
         await failed.delete()
         return
 
+@_loc.command(name="import")
+@commands.has_permissions(manage_guild=True)
+async def _loc_import(ctx):
+    """Imports locations from an attached CSV or GeoJSON file.
+
+    CSV files need a header with type, name, region, latitude and longitude
+    columns and may add a notes column. GeoJSON files need Point features with
+    type, name and region properties. Rows that fail validation are skipped
+    and listed in an error report once the import is done."""
+    channel = ctx.channel
+    if not ctx.message.attachments:
+        return await channel.send("Please attach a CSV or GeoJSON file when using this command.")
+    attachment = ctx.message.attachments[0]
+    extension = os.path.splitext(attachment.filename)[1].lower()
+    if extension == '.csv':
+        reader = locimport.read_csv
+    elif extension in ('.geojson', '.json'):
+        reader = locimport.read_geojson
+    else:
+        return await channel.send("Only .csv and .geojson files can be imported.")
+    def guild_names():
+        regions = {region.name.lower() for region in
+                   RegionTable.select(RegionTable.name).where(RegionTable.guild == ctx.guild.id)}
+        existing = {location.name.lower() for location in
+                    LocationTable.select(LocationTable.name).where(LocationTable.guild == ctx.guild.id)}
+        return regions, existing
+    regions, existing = await DobbyDB.guild(ctx.guild.id).read(guild_names)
+    chunk_rows = config.get('import_chunk_rows', 500)
+    loader = LocationLoader()
+    created = 0
+    errors = []
+    batch = []
+    status = await channel.send(f"Importing {attachment.filename}...")
+    last_update = time.monotonic()
+    with tempfile.TemporaryFile() as fd:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(attachment.url) as resp:
+                async for chunk in resp.content.iter_chunked(65536):
+                    fd.write(chunk)
+        fd.seek(0)
+        try:
+            for row, fields in reader(io.TextIOWrapper(fd, encoding='utf-8-sig', newline='')):
+                try:
+                    name, data, type = locimport.validate(fields, regions, existing)
+                except ValueError as e:
+                    errors.append(f"Row {row}: {e}")
+                    continue
+                data['guild'] = str(ctx.guild.id)
+                existing.add(name.lower())
+                batch.append((name, data, type))
+                if len(batch) >= chunk_rows:
+                    created += await DobbyDB.guild(ctx.guild.id).run(loader.load, batch)
+                    batch = []
+                    if time.monotonic() - last_update >= 5:
+                        await status.edit(content=f"Importing {attachment.filename}... "
+                                                  f"{created} added, {len(errors)} skipped so far.")
+                        last_update = time.monotonic()
+            if batch:
+                created += await DobbyDB.guild(ctx.guild.id).run(loader.load, batch)
+        except (locimport.LocationImportError, UnicodeDecodeError) as e:
+            errors.append(f"Import stopped: {e}")
+    logger.info(f'Imported {created} locations for guild {ctx.guild.id} '
+                f'({loader.rows} rows, {loader.rows_per_second:.0f} rows/s, {len(errors)} errors)')
+    await status.edit(content=f"Imported {created} locations from {attachment.filename}, "
+                              f"{len(errors)} rows skipped.")
+    if errors:
+        report = io.BytesIO('\n'.join(errors).encode('utf-8'))
+        await channel.send("Skipped rows:", file=discord.File(report, filename='import_errors.txt'))
+    await ctx.message.add_reaction('✅' if created else '❌')
+
     
 @_loc.command(name="changeregion", aliases=["cr"])
 @commands.has_permissions(manage_guild=True)
@@ -1423,7 +1809,7 @@ async def _loc_change_region(ctx, *, info):
     message = ctx.message
     author = message.author
     info = [x.strip() for x in info.split(',')]
-    inn, greenhouse, fortress = None, None
+    inn, greenhouse, fortress = None, None, None
     if len(info) != 3:
         failed = await channel.send(embed=discord.Embed(colour=discord.Colour.red(), description=f"Please provide (comma separated) the location type (fortress/inn/greenhouse), name of the location, and the new region it should be assigned to."))
         await message.add_reaction('❌')        
@@ -1431,17 +1817,17 @@ async def _loc_change_region(ctx, *, info):
         await failed.delete()
         return
     if info[0].lower() == "inn":
-        inns = get_inns(ctx.guild.id, None)
+        inns = await get_inns(ctx.guild.id, None)
         inn = await location_match_prompt(channel, author.id, info[1], inns)
         if inn is not None:
             name = inn.name
     elif info[0].lower() == "greenhouse":
-        greenhouses = get_greenhouses(ctx.guild.id, None)
+        greenhouses = await get_greenhouses(ctx.guild.id, None)
         greenhouse = await location_match_prompt(channel, author.id, info[1], greenhouses)
         if greenhouse is not None:
             name = greenhouse.name
     elif info[0].lower() == "fortress":
-        fortresses = get_fortresses(ctx.guild.id, None)
+        fortresses = await get_fortresses(ctx.guild.id, None)
         fortress = await location_match_prompt(channel, author.id, info[1], fortresses)
         if fortress is not None:
             name = fortress.name
@@ -1484,19 +1870,19 @@ async def _loc_deletelocation(ctx, *, info):
         await failed.delete()
         return
     type = info[0].lower()
-    inn, greenhouse, fortress = None
+    inn, greenhouse, fortress = None, None, None
     if type == "inn":
-        inns = get_inns(ctx.guild.id, None)
+        inns = await get_inns(ctx.guild.id, None)
         inn = await location_match_prompt(channel, author.id, info[1], inns)
         if inn is not None:
             name = inn.name
     elif type == "greenhouse":
-        greenhouses = get_greenhouses(ctx.guild.id, None)
+        greenhouses = await get_greenhouses(ctx.guild.id, None)
         greenhouse = await location_match_prompt(channel, author.id, info[1], greenhouses)
         if greenhouse is not None:
             name = greenhouse.name
     elif type == "fortress":
-        fortresses = get_fortresses(ctx.guild.id, None)
+        fortresses = await get_fortresses(ctx.guild.id, None)
         fortress = await location_match_prompt(channel, author.id, info[1], fortresses)
         if fortress is not None:
             name = fortress.name
@@ -1521,64 +1907,43 @@ async def _loc_deletelocation(ctx, *, info):
         return
 
 async def deleteLocation(ctx, type, name):
-    channel = ctx.channel
-    guild = ctx.guild
-    deleted = 0
-    with DobbyDB._db.atomic() as txn:
-        try:
-            locationresult = (LocationTable
-                .get((LocationTable.guild == guild.id) &
-                       (LocationTable.name == name)))
-            location = LocationTable.get_by_id(locationresult)
-            loc_reg = (LocationRegionRelation
-                .get(LocationRegionRelation.location_id == locationresult))
-            if type == "inn":
-                deleted = InnTable.delete().where(InnTable.location_id == locationresult).execute()
-            elif type == "greenhouse":
-                deleted = GreenhouseTable.delete().where(GreenhouseTable.location_id == locationresult).execute()
-            elif type == "fortress":
-                deleted = FortressTable.delete().where(FortressTable.location_id == locationresult).execute()
-            deleted += LocationRegionRelation.delete().where(LocationRegionRelation.id == loc_reg).execute()
-            deleted += location.delete_instance()
-            txn.commit()
-        except Exception as e: 
-            await channel.send(e)
-            txn.rollback()
-    return deleted
-
+    try:
+        return await DobbyDB.guild(ctx.guild.id).transaction(LocationTable.delete_location, ctx.guild.id, type, name)
+    except Exception as e:
+        await ctx.channel.send(e)
+        return 0
+
+def _change_region(guild_id, name, region):
+    current = (LocationTable
+              .select(LocationTable.id.alias('loc_id'))
+              .join(LocationRegionRelation)
+              .join(RegionTable)
+              .where((LocationTable.guild == guild_id) &
+                     (LocationTable.guild == RegionTable.guild) &
+                     (LocationTable.name == name)))
+    loc_id = current[0].loc_id
+    current = (RegionTable
+               .select(RegionTable.id.alias('reg_id'))
+               .join(LocationRegionRelation)
+               .join(LocationTable)
+               .where((LocationTable.guild == guild_id) &
+                      (LocationTable.guild == RegionTable.guild) &
+                      (LocationTable.id == loc_id)))
+    reg_id = current[0].reg_id
+    deleted = LocationRegionRelation.delete().where((LocationRegionRelation.location_id == loc_id) &
+                                                    (LocationRegionRelation.region_id == reg_id)).execute()
+    new = (RegionTable
+           .select(RegionTable.id)
+           .where((RegionTable.name == region) &
+                  (RegionTable.guild_id == guild_id)))
+    return LocationRegionRelation.create(location=loc_id, region=new[0].id)
 
 async def changeRegion(ctx, name, region):
-    region = region.lower()
-    success = 0
-    with DobbyDB._db.atomic() as txn:
-        try:
-            current = (LocationTable
-                      .select(LocationTable.id.alias('loc_id'))
-                      .join(LocationRegionRelation)
-                      .join(RegionTable)
-                      .where((LocationTable.guild == ctx.guild.id) &
-                             (LocationTable.guild == RegionTable.guild) &
-                             (LocationTable.name == name)))
-            loc_id = current[0].loc_id
-            current = (RegionTable
-                       .select(RegionTable.id.alias('reg_id'))
-                       .join(LocationRegionRelation)
-                       .join(LocationTable)
-                       .where((LocationTable.guild == ctx.guild.id) &
-                              (LocationTable.guild == RegionTable.guild) &
-                              (LocationTable.id == loc_id)))
-            reg_id = current[0].reg_id
-            deleted = LocationRegionRelation.delete().where((LocationRegionRelation.location_id == loc_id) &
-                                                            (LocationRegionRelation.region_id == reg_id)).execute()
-            new = (RegionTable
-                   .select(RegionTable.id)
-                   .where((RegionTable.name == region) &
-                          (RegionTable.guild_id == ctx.guild.id)))
-            success = LocationRegionRelation.create(location=loc_id, region=new[0].id)
-        except Exception as e: 
-            await ctx.channel.send(e)
-            txn.rollback()
-    return success
+    try:
+        return await DobbyDB.guild(ctx.guild.id).transaction(_change_region, ctx.guild.id, name, region.lower())
+    except Exception as e:
+        await ctx.channel.send(e)
+        return 0
 
 
 @Dobby.command(name="refresh_listings", hidden=True)
@@ -1650,7 +2015,9 @@ async def _update_listing_channel(channel, type, edit, region=None):
             listing_dict['channel']['messages'] = new_ids
         elif 'channels' in listing_dict:
             listing_dict['channels'][region]['messages'] = new_ids
-        guild_dict[channel.guild.id]['configure_dict'][type]['listings'] = listing_dict
+        # reassigned through the overlay, the listing config isn't a default so it's a plain dict
+        configure_dict = guild_dict[channel.guild.id]['configure_dict']
+        configure_dict[type] = dict(configure_dict[type], listings=listing_dict)
 
 async def _get_previous_listing_messages(type, channel, region=None):
     listing_dict = guild_dict[channel.guild.id]['configure_dict'].get(type, {}).get('listings', None)
@@ -1678,7 +2045,17 @@ async def _get_previous_listing_messages(type, channel, region=None):
                     break
     return previous_messages
 
+def _mark_ready():
+    # the launcher waits for this file before starting a standby or promoting this one
+    if 'launcher' in sys.argv[1:]:
+        with open(os.path.join('data', f'ready-{os.getpid()}'), 'w'):
+            pass
+
 try:
+    _mark_ready()
+    if 'standby' in sys.argv[1:]:
+        event_loop.run_until_complete(_standby())
+        _mark_ready()
     event_loop.run_until_complete(Dobby.start(config['bot_token']))
 except discord.LoginFailure:
     logger.critical('Invalid token')
@@ -1 +1,12 @@
-MAX_MESSAGE_LENGTH = 2000
\ No newline at end of file
+# Shared default for every guild's entry in guild_dict. Guilds only store the
+# keys they have changed, everything else is read from here.
+DEFAULT_GUILD = {
+    'configure_dict': {
+        'welcome': {'enabled': False, 'welcomechan': '', 'welcomemsg': ''},
+        'invite': {'enabled': False},
+        'house': {'enabled': False, 'sort_channels': []},
+        'profession': {'enabled': False, 'sort_channels': []},
+        'settings': {'offset': 0, 'regional': None, 'done': False, 'prefix': None, 'config_sessions': {}}
+    },
+    'wizards': {}
+}
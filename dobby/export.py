@@ -0,0 +1,161 @@
+import csv
+import gzip
+import io
+import json
+import time
+import zipfile
+
+from peewee import JOIN, Case, fn
+
+from dobby.exts.db.dobbydb import (BadgeAssignmentTable, BadgeTable, EventTable, HouseTable, LocationLoader,
+                                   LocationNoteTable, LocationRegionRelation, LocationTable, ProfessionTable,
+                                   ProfileTable, RegionTable, WizardTable)
+
+EXPORT_FORMATS = ('jsonl', 'csv')
+
+
+def _location_type():
+    type_tables = LocationLoader.type_tables
+    return Case(None, [(table.location.is_null(False), name) for name, table in type_tables.items()])
+
+
+def _locations(guild_id):
+    query = LocationTable.select()
+    for table in LocationLoader.type_tables.values():
+        query = query.switch(LocationTable).join(table, JOIN.LEFT_OUTER)
+    return query.where(LocationTable.guild == guild_id)
+
+
+def export_tables(guild_id):
+    """Returns ``(name, key, columns, query)`` for each table of a guild's export.
+
+    ``columns`` maps column names to the expressions selected from ``query``
+    and ``key`` is a unique column the rows are ordered and resumed by. The
+    locations table has the columns ``!loc import`` reads, so it can be
+    imported into another server as it is."""
+    regions = (LocationRegionRelation.select(fn.GROUP_CONCAT(RegionTable.name, '|'))
+               .join(RegionTable)
+               .where(LocationRegionRelation.location == LocationTable.id))
+    notes = (LocationNoteTable.select(fn.GROUP_CONCAT(LocationNoteTable.note, '|'))
+             .where(LocationNoteTable.location == LocationTable.id))
+    return [
+        ('regions', RegionTable.id,
+         {'id': RegionTable.id, 'name': RegionTable.name, 'area': RegionTable.area},
+         RegionTable.select().where(RegionTable.guild == guild_id)),
+        ('locations', LocationTable.id,
+         {'id': LocationTable.id, 'type': _location_type(), 'name': LocationTable.name, 'region': regions,
+          'latitude': LocationTable.latitude, 'longitude': LocationTable.longitude, 'notes': notes},
+         _locations(guild_id)),
+        ('notes', LocationNoteTable.id,
+         {'id': LocationNoteTable.id, 'location': LocationNoteTable.location, 'note': LocationNoteTable.note},
+         LocationNoteTable.select().join(LocationTable).where(LocationTable.guild == guild_id)),
+        ('events', EventTable.id,
+         {'id': EventTable.id, 'eventname': EventTable.eventname, 'active': EventTable.active,
+          'role': EventTable.role},
+         EventTable.select().where(EventTable.guild == guild_id)),
+        ('badges', BadgeAssignmentTable.id,
+         {'id': BadgeAssignmentTable.id, 'wizard': BadgeAssignmentTable.wizard, 'badge': BadgeAssignmentTable.badge,
+          'badge_name': BadgeTable.name, 'created': BadgeAssignmentTable.created},
+         BadgeAssignmentTable.select().join(BadgeTable).where(BadgeAssignmentTable.guild == guild_id)),
+        ('wizards', WizardTable.id,
+         {'id': WizardTable.id, 'snowflake': WizardTable.snowflake, 'house': HouseTable.name,
+          'profession': ProfessionTable.name},
+         WizardTable.select()
+         .join(HouseTable, JOIN.LEFT_OUTER)
+         .switch(WizardTable)
+         .join(ProfessionTable, JOIN.LEFT_OUTER)
+         .where(WizardTable.guild == guild_id)),
+        ('profiles', ProfileTable.id,
+         {'id': ProfileTable.id, 'wizard': WizardTable.snowflake, 'wizardname': ProfileTable.wizardname,
+          'level': ProfileTable.level, 'title_one': ProfileTable.title_one, 'title_two': ProfileTable.title_two,
+          'title_three': ProfileTable.title_three},
+         ProfileTable.select().join(WizardTable).where(WizardTable.guild == guild_id))
+    ]
+
+
+class GuildExport:
+    """Streams a guild's tables into a compressed archive.
+
+    ``jsonl`` writes one gzipped file with a ``{"table": ..., "row": {...}}``
+    line per row, ``csv`` a zip with one csv file per table. Rows are read
+    ``chunk_rows`` at a time, resuming after the last key written, and each
+    chunk is written and compressed on the reader thread before the next one
+    is queued. Only one chunk is ever held in memory and no read transaction
+    stays open between chunks, so large guilds neither grow the bot nor hold
+    back WAL checkpoints."""
+
+    def __init__(self, guild_id, format='jsonl', chunk_rows=1000):
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"unknown export format '{format}'")
+        self.guild_id = guild_id
+        self.format = format
+        self.chunk_rows = chunk_rows
+        self.rows = {}
+        self.chunks = 0
+        self.elapsed = 0
+        self._archive = None
+        self._out = None
+        self._writer = None
+
+    @property
+    def filename(self):
+        return f'export-{self.guild_id}.' + ('jsonl.gz' if self.format == 'jsonl' else 'zip')
+
+    @property
+    def total_rows(self):
+        return sum(self.rows.values())
+
+    def _begin_table(self, name, columns):
+        if self.format == 'jsonl':
+            self._writer = lambda row: self._out.write(json.dumps({'table': name, 'row': dict(zip(columns, row))},
+                                                                  default=str) + '\n')
+            return
+        self._out = io.TextIOWrapper(self._archive.open(f'{name}.csv', 'w'), encoding='utf-8', newline='')
+        writer = csv.writer(self._out)
+        writer.writerow(columns)
+        self._writer = writer.writerow
+
+    def _end_table(self):
+        if self.format == 'csv':
+            self._out.close()
+
+    def _write_chunk(self, key, columns, query, after):
+        query = query.select(*[expr.alias(name) for name, expr in columns.items()])
+        if after is not None:
+            query = query.where(key > after)
+        last = None
+        count = 0
+        for row in query.order_by(key).limit(self.chunk_rows).tuples().iterator():
+            self._writer(row)
+            last = row[0]
+            count += 1
+        return last, count
+
+    async def write(self, database, fd):
+        """Writes the archive to the binary file ``fd``, reading through ``database``."""
+        start = time.perf_counter()
+        if self.format == 'jsonl':
+            self._archive = gzip.GzipFile(filename=f'export-{self.guild_id}.jsonl', mode='wb', compresslevel=6,
+                                          fileobj=fd)
+            self._out = io.TextIOWrapper(self._archive, encoding='utf-8')
+        else:
+            self._archive = zipfile.ZipFile(fd, 'w', compression=zipfile.ZIP_DEFLATED)
+        try:
+            for name, key, columns, query in export_tables(self.guild_id):
+                # the key is always the first column, it's where the next chunk resumes from
+                self._begin_table(name, list(columns))
+                self.rows[name] = 0
+                after = None
+                while True:
+                    after, count = await database.read(self._write_chunk, key, columns, query, after)
+                    self.rows[name] += count
+                    self.chunks += 1
+                    if count < self.chunk_rows:
+                        break
+                self._end_table()
+        finally:
+            if self._out is not None:
+                self._out.close()
+            self._archive.close()
+        self.elapsed = time.perf_counter() - start
+        return self.total_rows
@@ -18,6 +18,7 @@ class Badge:
 class Badges(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        DobbyDB.queries.register('badges_by_wizard', self._badges_query, 'wizard')
 
     @commands.group(name='badge', aliases=['bg'])
     @commands.has_permissions(manage_roles=True)
@@ -46,8 +47,7 @@ class Badges(commands.Cog):
         if len(info) > 2:
             badge_desc = info[2]
         try:
-            new_badge, __ = BadgeTable.get_or_create(name=badge_name, description=badge_desc,
-                                                     emoji=badge_emoji.id, active=True)
+            new_badge = await DobbyDB.transaction(self._create_badge, badge_name, badge_desc, badge_emoji.id)
             if new_badge:
                 send_emoji = self.bot.get_emoji(badge_emoji.id)
                 message = f"{send_emoji} {badge_name} (#{new_badge.id}) successfully created!"
@@ -67,8 +67,9 @@ class Badges(commands.Cog):
     @_badge.command(name='toggle_available', aliases=['tg'])
     @commands.has_permissions(manage_roles=True)
     async def _toggle_available(self, ctx, badge_id: int = 0):
-        updated = BadgeTable.update(active=~BadgeTable.active).where(BadgeTable.id == badge_id).execute()
-        result = BadgeTable.select(BadgeTable.name, BadgeTable.active).where(BadgeTable.id == badge_id)
+        updated = await DobbyDB.transaction(self._toggle_badge, badge_id)
+        result = await DobbyDB.read(list, BadgeTable.select(BadgeTable.name, BadgeTable.active)
+                                    .where(BadgeTable.id == badge_id))
         if updated == 0:
             message = "No badge found by that id."
             colour = discord.Colour.red()
@@ -93,7 +94,7 @@ class Badges(commands.Cog):
                                     BadgeTable.description,
                                     BadgeTable.emoji,
                                     BadgeTable.active).where(BadgeTable.id == badge_id))
-        badge = result[0]
+        badge = (await DobbyDB.read(list, result))[0]
         send_emoji = self.bot.get_emoji(badge.emoji)
         title = f"(*#{badge.id}*) {badge.name}"
         message = f"{send_emoji} {badge.description}"
@@ -118,14 +119,13 @@ class Badges(commands.Cog):
         if badge_id == 0 or member is None:
             await ctx.message.add_reaction(self.bot.failed_react)
             return await ctx.send("Must provide a badge id and Wizard name.", delete_after=10)
-        badge_to_give = BadgeTable.get(BadgeTable.id == badge_id)
+        badge_to_give = await DobbyDB.read(BadgeTable.get, BadgeTable.id == badge_id)
         colour = discord.Colour.red()
         reaction = self.bot.failed_react
         if badge_to_give:
             try:
-                guild_obj, __ = GuildTable.get_or_create(snowflake=ctx.guild.id)
-                wizard_obj, __ = WizardTable.get_or_create(snowflake=member.id, guild=ctx.guild.id)
-                new_badge, __ = BadgeAssignmentTable.get_or_create(wizard=member.id, badge=badge_id)
+                new_badge = await DobbyDB.guild(ctx.guild.id).transaction(self._assign_badge, ctx.guild.id,
+                                                                          member.id, badge_id)
                 if new_badge:
                     send_emoji = self.bot.get_emoji(badge_to_give.emoji)
                     message = f"{member.display_name} has been given {send_emoji} **{badge_to_give.name}**!"
@@ -153,23 +153,12 @@ class Badges(commands.Cog):
         if badge_id == 0 or role is None:
             await ctx.message.add_reaction(self.bot.failed_react)
             return await ctx.send("Must provide a badge id and Role name.", delete_after=10)
-        badge_to_give = BadgeTable.get(BadgeTable.id == badge_id)
+        badge_to_give = await DobbyDB.read(BadgeTable.get, BadgeTable.id == badge_id)
         if badge_to_give:
             try:
-                wizard_ids = []
-                errored = []
-                guild_obj, __ = GuildTable.get_or_create(snowflake=ctx.guild.id)
-                for wizard in role.members:
-                    try:
-                        wizard_obj, __ = WizardTable.get_or_create(snowflake=wizard.id, guild=ctx.guild.id)
-                        wizard_ids.append((badge_to_give.id, wizard_obj.snowflake))
-                    except:
-                        errored.append(wizard.id)
-                with DobbyDB._db.atomic():
-                    count = BadgeAssignmentTable.insert_many(wizard_ids,
-                                                     fields=[BadgeAssignmentTable.badge_id,
-                                                             BadgeAssignmentTable.wizard])\
-                            .on_conflict_ignore().execute()
+                count, errored = await DobbyDB.guild(ctx.guild.id).run(self._assign_badge_to_members, ctx.guild.id,
+                                                                       [wizard.id for wizard in role.members],
+                                                                       badge_to_give.id)
                 message = f"Could not assign the badge to: {', '.join(errored)}"
             except Exception as e:
                 self.bot.logger.error(e)
@@ -186,6 +175,46 @@ class Badges(commands.Cog):
             await ctx.message.add_reaction(self.bot.success_react)
             return await ctx.channel.send(embed=discord.Embed(colour=colour, description=message))
 
+    @staticmethod
+    def _create_badge(name, description, emoji):
+        new_badge, __ = BadgeTable.get_or_create(name=name, description=description, emoji=emoji, active=True)
+        return new_badge
+
+    @staticmethod
+    def _toggle_badge(badge_id):
+        return BadgeTable.update(active=~BadgeTable.active).where(BadgeTable.id == badge_id).execute()
+
+    @staticmethod
+    def _assign_badge(guild_id, wizard_id, badge_id):
+        guild_obj, __ = GuildTable.get_or_create(snowflake=guild_id)
+        wizard_obj, __ = WizardTable.get_or_create(snowflake=wizard_id, guild=guild_id)
+        new_badge, __ = BadgeAssignmentTable.get_or_create(wizard=wizard_id, badge=badge_id, defaults={
+            'guild': guild_id, 'created': datetime.datetime.utcnow()})
+        return new_badge
+
+    @staticmethod
+    def _assign_badge_to_members(guild_id, wizard_ids, badge_id):
+        assignments = []
+        errored = []
+        now = datetime.datetime.utcnow()
+        guild_obj, __ = GuildTable.get_or_create(snowflake=guild_id)
+        for wizard_id in wizard_ids:
+            try:
+                wizard_obj = DobbyDB.queries.first('wizard', snowflake=wizard_id, guild=guild_id)
+                if wizard_obj is None:
+                    wizard_obj, __ = WizardTable.get_or_create(snowflake=wizard_id, guild=guild_id)
+                assignments.append((badge_id, wizard_obj.snowflake, guild_id, now))
+            except:
+                errored.append(wizard_id)
+        with DobbyDB._db.atomic():
+            count = BadgeAssignmentTable.insert_many(assignments,
+                                             fields=[BadgeAssignmentTable.badge_id,
+                                                     BadgeAssignmentTable.wizard,
+                                                     BadgeAssignmentTable.guild,
+                                                     BadgeAssignmentTable.created])\
+                    .on_conflict_ignore().execute()
+        return count, errored
+
     @commands.command(name="available_badges", aliases=['avb'])
     async def _available(self, ctx):
         """**Usage**: `!available_badges/avb`
@@ -197,7 +226,7 @@ class Badges(commands.Cog):
                           BadgeTable.emoji,
                           BadgeTable.active))
         result = result.objects(Badge)
-        result = [r for r in result if r.active]
+        result = [r for r in await DobbyDB.read(list, result) if r.active]
         embed = discord.Embed(title="Badges currently available", colour=discord.Colour.purple())
         for r in result:
             send_emoji = self.bot.get_emoji(r.emoji)
@@ -210,7 +239,11 @@ class Badges(commands.Cog):
         """**Usage**: `!badges`
         Shows all badges earned by whomever sent the command."""
         author = ctx.message.author
-        badges = self.get_badges(author.id)
+        # badges are global, with partitions the assignments are spread over every partition
+        badges = {}
+        for database in DobbyDB.handles():
+            badges.update({b.id: b for b in await database.read(self.get_badges, author.id)})
+        badges = sorted(badges.values(), key=lambda b: b.id)
         embed = discord.Embed(title=f"{author.display_name} has earned {len(badges)} badges", colour=author.colour)
         description = ''
         for b in badges:
@@ -228,6 +261,10 @@ class Badges(commands.Cog):
 
     @staticmethod
     def get_badges(user):
+        return DobbyDB.queries.run('badges_by_wizard', wizard=user)
+
+    @staticmethod
+    def _badges_query(user):
         result = (BadgeTable
                   .select(BadgeTable.id,
                           BadgeTable.name,
@@ -0,0 +1,135 @@
+import asyncio
+import datetime
+import glob
+import logging
+import os
+import re
+import time
+
+import apsw
+
+from dobby.exts.db.dobbydb import DobbyDB
+
+logger = logging.getLogger('dobby')
+
+
+class BackupResult:
+    def __init__(self, stamp, paths, pages, duration, max_step):
+        self.stamp = stamp
+        self.paths = paths
+        self.pages = pages
+        self.duration = duration
+        self.max_step = max_step
+
+    @property
+    def pages_per_second(self):
+        return self.pages / self.duration if self.duration else 0
+
+
+class OnlineBackup:
+    """Copies the live database into timestamped files with SQLite's online backup API.
+
+    Each step copies ``pages`` pages on the database thread, so a write waits
+    behind at most one step. Between steps the event loop runs for ``pause``
+    seconds. Writes made during the backup go through the same connection the
+    backup reads from and are copied as well, so the backup never restarts.
+    With partitions every database file is copied, one after the other, under
+    the same timestamp. Only the newest ``keep`` backups are kept."""
+
+    def __init__(self, directory, keep=8, pages=100, pause=0.005):
+        self.directory = directory
+        self.keep = keep
+        self.pages = pages
+        self.pause = pause
+        self.last = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self):
+        return self._lock.locked()
+
+    def backups(self):
+        """Returns the timestamps of the finished backups, oldest first."""
+        matches = [re.search(r'-(\d{8}-\d{6})\.db$', path) for path in glob.glob(os.path.join(self.directory, '*.db'))]
+        return sorted({match.group(1) for match in matches if match})
+
+    @staticmethod
+    def _begin(path):
+        dest = apsw.Connection(path)
+        # the final step would fsync on the database thread, the file is synced after instead
+        dest.cursor().execute('PRAGMA synchronous = OFF')
+        return dest, dest.backup('main', DobbyDB._db.connection(), 'main')
+
+    @staticmethod
+    def _sync(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _step(backup, pages):
+        start = time.perf_counter()
+        done = backup.step(pages)
+        return done, backup.pagecount, time.perf_counter() - start
+
+    @staticmethod
+    def _finish(dest, backup):
+        try:
+            backup.finish()
+        finally:
+            dest.close()
+
+    async def _copy(self, database, path):
+        """Copies one database file, returns ``(pages, longest step)``."""
+        partial = path + '.partial'
+        max_step = 0
+        dest, backup = await database.run(self._begin, partial)
+        try:
+            done = False
+            while not done:
+                done, pagecount, elapsed = await database.run(self._step, backup, self.pages)
+                max_step = max(max_step, elapsed)
+                if not done:
+                    await asyncio.sleep(self.pause)
+        except BaseException:
+            await database.run(self._finish, dest, backup)
+            os.remove(partial)
+            raise
+        await database.run(self._finish, dest, backup)
+        await asyncio.get_event_loop().run_in_executor(None, self._sync, partial)
+        os.replace(partial, path)
+        return pagecount, max_step
+
+    async def backup(self):
+        """Writes a new backup and rotates out old ones, returns a BackupResult."""
+        async with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            stamp = datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+            start = time.perf_counter()
+            paths = []
+            pages = 0
+            max_step = 0
+            for database in [DobbyDB] + DobbyDB.partitions:
+                name = os.path.splitext(os.path.basename(database.path))[0]
+                path = os.path.join(self.directory, f'{name}-{stamp}.db')
+                copied, longest = await self._copy(database, path)
+                paths.append(path)
+                pages += copied
+                max_step = max(max_step, longest)
+            self.last = BackupResult(stamp, paths, pages, time.perf_counter() - start, max_step)
+            for old in self.backups()[:-self.keep]:
+                for path in glob.glob(os.path.join(self.directory, f'*-{old}.db')):
+                    os.remove(path)
+            logger.info(f'Database backup {stamp}: {len(paths)} files, {pages} pages in {self.last.duration:.2f}s '
+                        f'({self.last.pages_per_second:.0f} pages/s, longest step {max_step * 1000:.2f}ms)')
+            return self.last
+
+    async def run(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.backup()
+            except Exception as e:
+                logger.error(f'Database backup failed: {e}')
@@ -1,39 +1,276 @@
+import asyncio
+import contextlib
+import datetime
+import functools
 import io
 import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import apsw
 from peewee import Proxy, chunked
-from playhouse.apsw_ext import *
-from playhouse.sqlite_ext import JSONField
+# migrate re-exports peewee's fields, import it first so the apsw_ext
+# versions (which convert dates and booleans for apsw) win
 from playhouse.migrate import *
+from playhouse.apsw_ext import *
+from playhouse.sqlite_ext import FTS5Model, JSONField, SearchField, VirtualModel
+
+from dobby.exts.db.migrations import MIGRATIONS, leaderboard_fill
+from dobby.exts.db.profiling import InstrumentedAPSWDatabase, QueryProfiler
+from dobby.exts.db.templates import QueryTemplateRegistry
+
+logger = logging.getLogger('dobby')
+
+_routes = threading.local()
+
+class RoutingProxy(Proxy):
+    """Database proxy that lets a thread send its queries to another database.
+
+    Threads that never call ``route`` use the database the proxy was
+    initialized with."""
+
+    def route(self, database):
+        _routes.database = database
+
+    @contextlib.contextmanager
+    def routed(self, database):
+        previous = getattr(_routes, 'database', None)
+        _routes.database = database
+        try:
+            yield
+        finally:
+            _routes.database = previous
+
+    @property
+    def target(self):
+        database = getattr(_routes, 'database', None)
+        return database if database is not None else self.obj
+
+    def __enter__(self):
+        return self.target.__enter__()
+
+    def __exit__(self, *args):
+        return self.target.__exit__(*args)
+
+    def __getattr__(self, attr):
+        if self.obj is None:
+            raise AttributeError('Cannot use uninitialized Proxy.')
+        return getattr(self.target, attr)
+
+class DBQueueStats:
+    """Counters for work queued on the database thread."""
+
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.total_wait = 0
+        self.max_wait = 0
+        self.total_run = 0
+        self.max_run = 0
+
+    @property
+    def depth(self):
+        return self.submitted - self.completed
+
+    @property
+    def average_wait(self):
+        return self.total_wait / self.completed if self.completed else 0
+
+    @property
+    def average_run(self):
+        return self.total_run / self.completed if self.completed else 0
+
+    def queued(self):
+        self.submitted += 1
+        self.max_depth = max(self.max_depth, self.depth)
+
+    def finished(self, wait, run, failed):
+        self.completed += 1
+        self.failed += failed
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.total_run += run
+        self.max_run = max(self.max_run, run)
 
 class DobbyDB:
-    _db = Proxy()
+    _db = RoutingProxy()
+    _reader = None
     _migrator = None
+    _executor = None
+    _reader_executor = None
+    stats = DBQueueStats()
+    read_stats = DBQueueStats()
+    queries = QueryTemplateRegistry(_db)
+    profiler = QueryProfiler()
+    path = None
+    partitions = []
+    partition_map = {}
+
     @classmethod
-    def start(cls, db_path):
-        handle = APSWDatabase(db_path, pragmas={
+    def start(cls, db_path, readers=4, partitions=0, partition_map=None, migrate=True):
+        """Opens the database and brings it up to date.
+
+        With ``partitions`` set, each guild's location, event and badge data
+        goes to one of that many files next to ``db_path``, see Partition.
+        ``partition_map`` gives chosen guilds a partition index of their own.
+        A standby passes ``migrate=False`` and leaves the schema, default data
+        and partition copies to the primary."""
+        handle = InstrumentedAPSWDatabase(db_path, profiler=cls.profiler, pragmas={
+            # only takes effect on a new database, see MaintenanceScheduler.full_vacuum
+            'auto_vacuum': 'incremental',
             'journal_mode': 'wal',
             'cache_size': -1 * 64000,
             'foreign_keys': 1,
             'ignore_check_constraints': 0
         })
+        cls.path = db_path
         cls._db.initialize(handle)
-        # ensure db matches current schema
-        cls._db.create_tables([
-            GuildTable, WizardTable,
-            HouseTable, ProfessionTable,
-            ProfileTable, TitleTable,
-            LocationTable, RegionTable, 
-            LocationRegionRelation, LocationNoteTable,
-            InnTable, GreenhouseTable, FortressTable,
-            WizardReportRelation, EventTable,
-            BadgeTable, BadgeAssignmentTable
-        ])
-        cls.init()
         cls._migrator = SqliteMigrator(cls._db)
+        # ensure db matches current schema
+        if partitions:
+            cls.partition_map = {int(guild_id): index for guild_id, index in (partition_map or {}).items()}
+            base = os.path.splitext(db_path)[0]
+            cls.partitions = [Partition(index, f'{base}-p{index}.db', db_path, cls.profiler, readers)
+                              for index in range(partitions)]
+        if migrate and partitions:
+            if 'locationtable' in cls._db.get_tables():
+                # guild data from before partitioning is copied out by Partition.open, bring it
+                # up to the current schema first so every column the copy names exists
+                cls._db.create_tables(SHARED_MODELS + PARTITIONED_MODELS)
+                cls.migrate()
+            else:
+                cls._db.create_tables(SHARED_MODELS)
+            cls.init()
+        elif migrate:
+            cls._db.create_tables(SHARED_MODELS + PARTITIONED_MODELS)
+            cls.migrate()
+            cls.init()
+            cls.init_guild_data()
+        for partition in cls.partitions:
+            partition.open(migrate)
+        # all writes made while the bot is running go through this thread
+        cls._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dobbydb')
+        # in wal mode readers see the last committed state without waiting on the writer
+        cls._reader = InstrumentedAPSWDatabase(db_path, profiler=cls.profiler,
+                                               flags=apsw.SQLITE_OPEN_READONLY, pragmas={
+            'cache_size': -1 * 16000,
+            'query_only': 1
+        })
+        cls._reader_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='dobbydb-reader',
+                                                  initializer=cls._db.route, initargs=(cls._reader,))
 
     @classmethod
     def stop(cls):
+        for partition in cls.partitions:
+            partition.stop()
+        if cls._reader_executor:
+            cls._reader_executor.shutdown()
+            cls._reader_executor = None
+        if cls._executor:
+            cls._executor.submit(cls._db.close).result()
+            cls._executor.shutdown()
+            cls._executor = None
         return cls._db.close()
+
+    @classmethod
+    def guild(cls, guild_id):
+        """Returns where a guild's location, event and badge data lives.
+
+        That is DobbyDB itself unless partitions are configured. Either way the
+        result has ``run``, ``read`` and ``transaction``."""
+        if not cls.partitions:
+            return cls
+        return cls.partitions[cls.partition_index(guild_id)]
+
+    @classmethod
+    def partition_index(cls, guild_id):
+        guild_id = int(guild_id)
+        if guild_id in cls.partition_map:
+            return cls.partition_map[guild_id]
+        # guilds without a mapping share the partitions no guild was given
+        dedicated = set(cls.partition_map.values())
+        indexes = [index for index in range(len(cls.partitions)) if index not in dedicated] or [0]
+        return indexes[guild_id % len(indexes)]
+
+    @classmethod
+    def handles(cls):
+        """Returns everything holding guild data, the partitions or DobbyDB itself."""
+        return cls.partitions or [cls]
+
+    @classmethod
+    def migrate(cls):
+        """Applies migrations newer than the last recorded version, each in its own transaction."""
+        applied = {row.version for row in MigrationTable.select(MigrationTable.version)}
+        foreign_keys = cls._db.pragma('foreign_keys')
+        for version, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+            if version in applied:
+                continue
+            if not fn.foreign_keys:
+                # only takes effect outside a transaction
+                cls._db.pragma('foreign_keys', 0)
+            try:
+                with cls._db.atomic():
+                    for operation in fn(cls._migrator):
+                        if isinstance(operation, Operation):
+                            operation.run()
+                        else:
+                            cls._db.execute(operation)
+                    if not fn.foreign_keys and cls._db.execute_sql('PRAGMA foreign_key_check').fetchall():
+                        raise IntegrityError(f'Migration {version} left foreign key violations')
+                    MigrationTable.create(version=version, name=fn.__name__)
+            finally:
+                if not fn.foreign_keys:
+                    cls._db.pragma('foreign_keys', foreign_keys)
+            logger.info(f'Applied database migration {version} ({fn.__name__})')
+
+    @classmethod
+    async def run(cls, fn, *args, **kwargs):
+        """Runs fn on the database thread and returns its result.
+
+        Calls are queued and run one at a time, so the event loop is never
+        blocked on SQLite and writes never contend with each other."""
+        return await cls._submit(cls._executor, cls.stats, fn, *args, **kwargs)
+
+    @classmethod
+    async def read(cls, fn, *args, **kwargs):
+        """Runs fn on one of the reader threads and returns its result.
+
+        Reader threads use read-only connections, so fn must not write. Reads
+        run in parallel with each other and with the writer thread."""
+        return await cls._submit(cls._reader_executor, cls.read_stats, fn, *args, **kwargs)
+
+    @classmethod
+    async def _submit(cls, executor, stats, fn, *args, **kwargs):
+        submitted = time.perf_counter()
+        stats.queued()
+
+        def call():
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                stats.finished(started - submitted, time.perf_counter() - started, failed)
+        return await asyncio.get_event_loop().run_in_executor(executor, call)
+
+    @classmethod
+    async def transaction(cls, fn, *args, **kwargs):
+        """Runs fn on the database thread inside a transaction.
+
+        The transaction is rolled back and the exception re-raised if fn raises."""
+        def atomic():
+            with cls._db.atomic():
+                return fn(*args, **kwargs)
+        return await cls.run(atomic)
     
     @classmethod
     def init(cls):
@@ -50,21 +287,155 @@ class DobbyDB:
             TitleTable.get()
         except:
             TitleTable.reload_default()
+
+    @classmethod
+    def init_guild_data(cls, guilds=None):
+        """Loads the default regions and locations, only those of ``guilds`` if given."""
         #check regions
         try:
             RegionTable.get()
         except:
-            RegionTable.reload_default()
+            RegionTable.reload_default(guilds)
         #check locations
         try:
             LocationTable.get()
         except:
-            LocationTable.reload_default()
+            LocationTable.reload_default(guilds)
+
+class Partition:
+    """A database file with the location, event and badge data of a group of guilds.
+
+    The main database is attached as ``shared``. SQLite looks up a table
+    name in the partition first and then in the attached databases, so the
+    same models and queries work on both. Foreign keys can't reference a
+    table in another file, so partitions run with enforcement off.
+
+    A partition has its own writer thread and reader pool, so a bulk write
+    in one guild group doesn't hold the write lock of any other."""
+
+    def __init__(self, index, path, shared_path, profiler, readers):
+        self.index = index
+        self.path = path
+        self.shared_path = shared_path
+        self.readers = readers
+        self.database = InstrumentedAPSWDatabase(path, profiler=profiler, pragmas={
+            'auto_vacuum': 'incremental',
+            'journal_mode': 'wal',
+            'cache_size': -1 * 16000,
+            'foreign_keys': 0
+        })
+        self.database.attach(shared_path, 'shared')
+        self.stats = DBQueueStats()
+        self.read_stats = DBQueueStats()
+        self._reader = None
+        self._executor = None
+        self._reader_executor = None
+
+    def open(self, migrate=True):
+        """Brings the partition's schema up to date and starts its threads."""
+        new = not os.path.exists(self.path)
+        if migrate:
+            self._migrate(new)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'dobbydb-p{self.index}',
+                                            initializer=DobbyDB._db.route, initargs=(self.database,))
+        # attached databases are opened with the same flags, so the shared tables are read only here too
+        self._reader = InstrumentedAPSWDatabase(self.path, profiler=self.database.profiler,
+                                                flags=apsw.SQLITE_OPEN_READONLY, pragmas={
+            'cache_size': -1 * 8000,
+            'query_only': 1
+        })
+        self._reader.attach(self.shared_path, 'shared')
+        self._reader_executor = ThreadPoolExecutor(max_workers=self.readers,
+                                                   thread_name_prefix=f'dobbydb-p{self.index}-reader',
+                                                   initializer=DobbyDB._db.route, initargs=(self._reader,))
+
+    def _migrate(self, new):
+        with DobbyDB._db.routed(self.database):
+            DobbyDB._db.create_tables(PARTITIONED_MODELS + [MigrationTable])
+            DobbyDB.migrate()
+            if new:
+                try:
+                    self._copy_shared()
+                except Exception:
+                    # the copy only happens for a new file, leave none behind so the next start retries it
+                    self.database.close()
+                    for suffix in ('', '-wal', '-shm'):
+                        if os.path.exists(self.path + suffix):
+                            os.remove(self.path + suffix)
+                    raise
+            DobbyDB.init_guild_data(lambda guild_id: DobbyDB.partition_index(guild_id) == self.index)
+
+    def _copy_shared(self):
+        # a deployment switching to partitions has its guild data in the shared database,
+        # the triggers rebuild the search, R*Tree and leaderboard tables as rows are copied
+        tables = {row[0] for row in DobbyDB._db.execute_sql("SELECT name FROM shared.sqlite_master WHERE type = 'table'")}
+        if 'locationtable' not in tables:
+            return
+        guilds = [row[0] for row in DobbyDB._db.execute_sql('SELECT snowflake FROM shared.guildtable')
+                  if DobbyDB.partition_index(row[0]) == self.index]
+        in_guilds = f"IN ({', '.join(str(int(guild_id)) for guild_id in guilds) or 'NULL'})"
+        in_locations = 'IN (SELECT "id" FROM main."locationtable")'
+        filters = [
+            (RegionTable, f'"guild_id" {in_guilds}'),
+            (LocationTable, f'"guild_id" {in_guilds}'),
+            (LocationNoteTable, f'"location_id" {in_locations}'),
+            (LocationRegionRelation, f'"location_id" {in_locations}'),
+            (InnTable, f'"location_id" {in_locations}'),
+            (GreenhouseTable, f'"location_id" {in_locations}'),
+            (FortressTable, f'"location_id" {in_locations}'),
+            (WizardReportRelation, f'"location_id" {in_locations}'),
+            (EventTable, f'"guild_id" {in_guilds}'),
+            (BadgeAssignmentTable, f'"guild" {in_guilds}' + (' OR "guild" IS NULL' if self.index == 0 else ''))
+        ]
+        copied = 0
+        with DobbyDB._db.atomic():
+            for model, where in filters:
+                table = model._meta.table_name
+                if table not in tables:
+                    continue
+                names = [field.column_name for field in model._meta.sorted_fields]
+                existing = {column.name for column in DobbyDB._db.get_columns(table, schema='shared')}
+                missing = [name for name in names if name not in existing]
+                if missing:
+                    # a missing column would be read as a string literal and the rows silently skipped
+                    raise OperationalError(f"shared.{table} has no column {', '.join(missing)}, "
+                                           f"migrate the shared database before partitioning")
+                columns = ', '.join(f'"{name}"' for name in names)
+                cursor = DobbyDB._db.execute_sql(f'INSERT INTO main."{table}" ({columns}) '
+                                                 f'SELECT {columns} FROM shared."{table}" WHERE {where}')
+                copied += DobbyDB._db.rows_affected(cursor)
+        logger.info(f'Copied {copied} rows for {len(guilds)} guilds from the shared database into {self.path}')
+
+    def stop(self):
+        if self._reader_executor:
+            self._reader_executor.shutdown()
+            self._reader_executor = None
+        if self._executor:
+            self._executor.submit(self.database.close).result()
+            self._executor.shutdown()
+            self._executor = None
+
+    async def run(self, fn, *args, **kwargs):
+        return await DobbyDB._submit(self._executor, self.stats, fn, *args, **kwargs)
+
+    async def read(self, fn, *args, **kwargs):
+        return await DobbyDB._submit(self._reader_executor, self.read_stats, fn, *args, **kwargs)
+
+    async def transaction(self, fn, *args, **kwargs):
+        def atomic():
+            with DobbyDB._db.atomic():
+                return fn(*args, **kwargs)
+        return await self.run(atomic)
 
 class BaseModel(Model):
     class Meta:
         database = DobbyDB._db
 
+class MigrationTable(BaseModel):
+    version = IntegerField(primary_key=True)
+    name = TextField()
+    applied = DateTimeField(default=datetime.datetime.utcnow)
+
 class HouseTable(BaseModel):
     name = TextField(unique=True)
     emoji = TextField()
@@ -99,9 +470,13 @@ class ProfessionTable(BaseModel):
         for name, emoji in profession_data.items():
             cls.insert(name=name, emoji=emoji).execute()
 
+def snowflake_keys(pairs):
+    # JSON turns the snowflake keys used throughout guild config into strings
+    return {int(k) if k.isdigit() else k: v for k, v in pairs}
+
 class GuildTable(BaseModel):
     snowflake = BigIntegerField(unique=True)
-    config_dict = JSONField(null=True)
+    config_dict = JSONField(null=True, json_loads=functools.partial(json.loads, object_pairs_hook=snowflake_keys))
 
 class WizardTable(BaseModel):
     snowflake = BigIntegerField(index=True)
@@ -112,6 +487,10 @@ class WizardTable(BaseModel):
     class Meta:
         constraints = [SQL('UNIQUE(snowflake, guild_id)')]
 
+DobbyDB.queries.register('wizard', lambda snowflake, guild: (
+    WizardTable.select().where((WizardTable.snowflake == snowflake) & (WizardTable.guild == guild))),
+    'snowflake', 'guild')
+
 class TitleTable(BaseModel):
     name = TextField()
 
@@ -146,7 +525,7 @@ class RegionTable(BaseModel):
     guild = ForeignKeyField(GuildTable, field=GuildTable.snowflake, backref='regions', index=True)
 
     @classmethod
-    def reload_default(cls):
+    def reload_default(cls, guilds=None):
         if not DobbyDB._db:
             return
         try:
@@ -155,6 +534,10 @@ class RegionTable(BaseModel):
             pass
         with open('data/region_data.json', 'r') as f:
             region_data = json.load(f)
+        if guilds:
+            region_data = [dict(region, guild=','.join(guild_id for guild_id in _split_list(region.get('guild'))
+                                                        if guilds(guild_id)))
+                           for region in region_data]
         with DobbyDB._db.atomic():
             for region in region_data:
                 try:
@@ -169,11 +552,16 @@ class RegionTable(BaseModel):
     class Meta:
         constraints = [SQL('UNIQUE(name, guild_id)')]
 
+def haversine_km(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371.0088 * math.asin(math.sqrt(a))
+
 class LocationTable(BaseModel):
     id = AutoField()
     name = TextField(index=True)
-    latitude = TextField()
-    longitude = TextField()
+    latitude = FloatField()
+    longitude = FloatField()
     guild = ForeignKeyField(GuildTable, field=GuildTable.snowflake, backref='locations', index=True)
 
     @classmethod
@@ -205,7 +593,27 @@ class LocationTable(BaseModel):
             print(e)
 
     @classmethod
-    def reload_default(cls):
+    def delete_location(cls, guild_id, type, name):
+        """Deletes a location and every row referencing it, returns the number of rows deleted.
+
+        Run it inside a transaction, it's several statements."""
+        deleted = 0
+        location = cls.get((cls.guild == guild_id) & (cls.name == name))
+        if type == "inn":
+            deleted = InnTable.delete().where(InnTable.location_id == location.id).execute()
+        elif type == "greenhouse":
+            deleted = GreenhouseTable.delete().where(GreenhouseTable.location_id == location.id).execute()
+        elif type == "fortress":
+            deleted = FortressTable.delete().where(FortressTable.location_id == location.id).execute()
+        deleted += LocationRegionRelation.delete().where(LocationRegionRelation.location_id == location.id).execute()
+        LocationNoteTable.delete().where(LocationNoteTable.location_id == location.id).execute()
+        # reports reference the location, the leaderboard triggers take them back out of the counts
+        WizardReportRelation.delete().where(WizardReportRelation.location_id == location.id).execute()
+        deleted += location.delete_instance()
+        return deleted
+
+    @classmethod
+    def reload_default(cls, guilds=None):
         if not DobbyDB._db:
             return
         try:
@@ -218,12 +626,84 @@ class LocationTable(BaseModel):
             inn_data = json.load(f)
         with io.open('data/greenhouse_data.json', mode="r", encoding="utf-8") as f:
             greenhouse_data = json.load(f)
-        for name, data in fortress_data.items():
-            LocationTable.create_location(name, data, 'fortress')
-        for name, data in inn_data.items():
-            LocationTable.create_location(name, data, 'inn')
-        for name, data in greenhouse_data.items():
-            LocationTable.create_location(name, data, 'greenhouse')
+        entries = [(name, data, 'fortress') for name, data in fortress_data.items()]
+        entries += [(name, data, 'inn') for name, data in inn_data.items()]
+        entries += [(name, data, 'greenhouse') for name, data in greenhouse_data.items()]
+        if guilds:
+            entries = [(name, dict(data, guild=','.join(guild_id for guild_id in _split_list(data.get('guild'))
+                                                         if guilds(guild_id))), type)
+                       for name, data, type in entries]
+        loader = LocationLoader()
+        created = loader.load(entries)
+        logger.info(f'Loaded {created} default locations ({loader.rows} rows in {loader.elapsed:.2f}s, '
+                    f'{loader.rows_per_second:.0f} rows/s)')
+
+    @classmethod
+    def nearby(cls, guild_id, latitude, longitude, type=None, k=5):
+        """Returns up to k ``(location, type, km)`` tuples closest to the given point.
+
+        Candidates come from an R*Tree bounding box that grows until it holds k
+        locations no farther away than its radius, and are then ranked by
+        great-circle distance."""
+        type_tables = LocationLoader.type_tables
+        radius = 1
+        while True:
+            dlat = radius / 111.32
+            # a degree of longitude is narrowest at the box's poleward edge, not at its centre
+            dlng = radius / max(111.32 * math.cos(math.radians(min(90, abs(latitude) + dlat))), 0.01)
+            query = (cls
+                     .select(cls.id, cls.name, cls.latitude, cls.longitude,
+                             *[table.location.alias(name) for name, table in type_tables.items()])
+                     .join(LocationRTree, on=(LocationRTree.id == cls.id)))
+            for table in type_tables.values():
+                query = query.switch(cls).join(table, JOIN.LEFT_OUTER)
+            query = query.where((cls.guild == guild_id) &
+                                (LocationRTree.max_lat >= latitude - dlat) &
+                                (LocationRTree.min_lat <= latitude + dlat) &
+                                (LocationRTree.max_lng >= longitude - dlng) &
+                                (LocationRTree.min_lng <= longitude + dlng))
+            if type:
+                query = query.where(type_tables[type].location.is_null(False))
+            ranked = sorted(((location, next((name for name in type_tables if getattr(location, name)), None),
+                              haversine_km(latitude, longitude, location.latitude, location.longitude))
+                             for location in query.objects()), key=lambda t: t[2])
+            # half the earth's circumference, the box covers everything
+            if (len(ranked) >= k and ranked[k - 1][2] <= radius) or radius >= 20016:
+                return ranked[:k]
+            radius *= 4
+
+class LocationRTree(VirtualModel):
+    """R*Tree over location coordinates, created and kept in sync by migration 2."""
+    id = IntegerField(primary_key=True)
+    min_lat = FloatField()
+    max_lat = FloatField()
+    min_lng = FloatField()
+    max_lng = FloatField()
+
+    class Meta:
+        database = DobbyDB._db
+        table_name = 'locationrtree'
+        extension_module = 'rtree'
+
+class LocationSearch(FTS5Model):
+    """FTS5 index over location names, notes and regions, created and kept in sync by migration 3.
+
+    The rowid is the location id."""
+    name = SearchField()
+    notes = SearchField()
+    regions = SearchField()
+
+    class Meta:
+        database = DobbyDB._db
+        table_name = 'locationsearch'
+
+    @staticmethod
+    def prefix_query(text, operator='AND'):
+        """Turns free text into a MATCH expression of quoted prefix terms, or None if it has no words."""
+        tokens = re.findall(r'\w+', text)
+        if not tokens:
+            return None
+        return f' {operator} '.join(f'"{token}"*' for token in tokens)
 
 class LocationNoteTable(BaseModel):
     location = ForeignKeyField(LocationTable, backref='notes')
@@ -242,9 +722,104 @@ class GreenhouseTable(BaseModel):
 class FortressTable(BaseModel):
     location = ForeignKeyField(LocationTable, backref='fortresses', primary_key=True)
 
+def _split_list(value):
+    return [item for item in (value or '').split(',') if item]
+
+class LocationLoader:
+    """Bulk inserts locations given as ``(name, data, type)`` entries.
+
+    ``data`` has the shape of the default location json files. Guilds and
+    regions are resolved once per load and location ids are assigned up front,
+    so locations, region relations, notes and type rows all go in as chunked
+    ``insert_many`` batches inside a single transaction."""
+
+    type_tables = {
+        'fortress': FortressTable,
+        'inn': InnTable,
+        'greenhouse': GreenhouseTable
+    }
+    # SQLite's default SQLITE_MAX_VARIABLE_NUMBER
+    max_variables = 999
+
+    def __init__(self):
+        self.rows = 0
+        self.elapsed = 0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0
+
+    def _insert(self, model, fields, rows):
+        for batch in chunked(rows, self.max_variables // len(fields)):
+            model.insert_many(batch, fields=fields).execute()
+        self.rows += len(rows)
+
+    def _resolve_guilds(self, guild_ids):
+        existing = {guild.snowflake for guild in GuildTable.select(GuildTable.snowflake)}
+        missing = [(guild_id,) for guild_id in guild_ids if guild_id not in existing]
+        self._insert(GuildTable, [GuildTable.snowflake], missing)
+
+    def _resolve_regions(self, region_keys):
+        guild_ids = {guild_id for guild_id, __ in region_keys}
+        query = (RegionTable
+                 .select(RegionTable.id, RegionTable.name, RegionTable.guild)
+                 .where(RegionTable.guild.in_(list(guild_ids))))
+        regions = {(region.guild_id, region.name): region.id for region in query}
+        missing = [(name, guild_id) for guild_id, name in region_keys if (guild_id, name) not in regions]
+        if missing:
+            self._insert(RegionTable, [RegionTable.name, RegionTable.guild], missing)
+            regions = {(region.guild_id, region.name): region.id for region in query.clone()}
+        return regions
+
+    def load(self, entries):
+        """Inserts the entries and returns the number of locations created.
+
+        Raises ValueError for an unknown location type before anything is written."""
+        start = time.perf_counter()
+        entries = list(entries)
+        for name, data, type in entries:
+            if type not in self.type_tables:
+                raise ValueError(f'Unknown location type {type} for {name}')
+        guild_ids = set()
+        region_keys = set()
+        for name, data, type in entries:
+            for guild_id in _split_list(data.get('guild')):
+                guild_ids.add(int(guild_id))
+                for region_name in _split_list(data.get('region')):
+                    region_keys.add((int(guild_id), region_name))
+        locations = []
+        relations = []
+        notes = []
+        types = {type: [] for type in self.type_tables}
+        with DobbyDB._db.atomic():
+            self._resolve_guilds(guild_ids)
+            regions = self._resolve_regions(region_keys)
+            location_id = (LocationTable.select(fn.MAX(LocationTable.id)).scalar() or 0) + 1
+            for name, data, type in entries:
+                latitude, longitude = data['coordinates'].split(',')
+                for guild_id in _split_list(data.get('guild')):
+                    guild_id = int(guild_id)
+                    locations.append((location_id, name, float(latitude), float(longitude), guild_id))
+                    for region_name in _split_list(data.get('region')):
+                        relations.append((location_id, regions[(guild_id, region_name)]))
+                    for note in data.get('notes', []):
+                        notes.append((location_id, note))
+                    types[type].append((location_id,))
+                    location_id += 1
+            self._insert(LocationTable, [LocationTable.id, LocationTable.name, LocationTable.latitude,
+                                         LocationTable.longitude, LocationTable.guild], locations)
+            self._insert(LocationRegionRelation, [LocationRegionRelation.location,
+                                                  LocationRegionRelation.region], relations)
+            self._insert(LocationNoteTable, [LocationNoteTable.location, LocationNoteTable.note], notes)
+            for type, rows in types.items():
+                table = self.type_tables[type]
+                self._insert(table, [table.location], rows)
+        self.elapsed += time.perf_counter() - start
+        return len(locations)
+
 class WizardReportRelation(BaseModel):
     id = AutoField()
-    created = DateTimeField(index=True,formats=["%Y-%m-%d %H:%M:%s"])
+    created = DateTimeField(index=True,formats=["%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"])
     wizard = BigIntegerField(index=True)
     location = ForeignKeyField(LocationTable, index=True)
 
@@ -269,6 +844,66 @@ class BadgeTable(BaseModel):
 class BadgeAssignmentTable(BaseModel):
     wizard = BigIntegerField(index=True)
     badge = ForeignKeyField(BadgeTable, field=BadgeTable.id, backref='badgeassignment', index=True)
+    guild = BigIntegerField(null=True)
+    created = DateTimeField(null=True, formats=["%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S"])
 
     class Meta:
         constraints = [SQL('UNIQUE(wizard, badge_id)')]
+
+class LeaderboardTable(BaseModel):
+    """Report and badge counts per wizard and bucket, maintained by triggers.
+
+    ``period`` is day, week or all and ``bucket`` the day, the monday starting
+    the week, or empty. Wizard 0 holds the guild total for the bucket."""
+    kind = TextField()
+    guild = BigIntegerField()
+    wizard = BigIntegerField()
+    period = TextField()
+    bucket = TextField()
+    total = IntegerField(default=0)
+
+    class Meta:
+        primary_key = CompositeKey('kind', 'guild', 'period', 'bucket', 'wizard')
+        indexes = ((('kind', 'guild', 'period', 'bucket', 'total'), False),)
+
+    @staticmethod
+    def bucket_for(period, when=None):
+        when = (when or datetime.datetime.utcnow()).date()
+        if period == 'day':
+            return when.isoformat()
+        if period == 'week':
+            return (when - datetime.timedelta(days=when.weekday())).isoformat()
+        return ''
+
+    @classmethod
+    def top_query(cls, kind, guild, period, bucket, limit):
+        return (cls.select(cls.wizard, cls.total)
+                .where((cls.kind == kind) & (cls.guild == guild) & (cls.period == period) & (cls.bucket == bucket))
+                .order_by(cls.total.desc())
+                .limit(limit))
+
+    @classmethod
+    def rebuild(cls):
+        """Recounts every summary from the report and badge tables, returns the number of rows written."""
+        with cls._meta.database.atomic():
+            for statement in leaderboard_fill():
+                cls._meta.database.execute(statement)
+        return cls.select().count()
+
+DobbyDB.queries.register('leaderboard', LeaderboardTable.top_query, 'kind', 'guild', 'period', 'bucket', 'limit')
+
+# tables holding per guild data, these live in the partitions when DobbyDB is partitioned
+PARTITIONED_MODELS = [
+    RegionTable, LocationTable,
+    LocationRegionRelation, LocationNoteTable,
+    InnTable, GreenhouseTable, FortressTable,
+    WizardReportRelation, EventTable,
+    BadgeAssignmentTable, LeaderboardTable
+]
+
+SHARED_MODELS = [
+    GuildTable, WizardTable,
+    HouseTable, ProfessionTable,
+    ProfileTable, TitleTable,
+    BadgeTable, MigrationTable
+]
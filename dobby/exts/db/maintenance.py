@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import os
+import time
+
+from dobby.exts.db.dobbydb import DobbyDB
+
+logger = logging.getLogger('dobby')
+
+
+class MaintenanceTask:
+    def __init__(self, name, interval, fn):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.runs = 0
+        self.failed = 0
+        self.total_time = 0
+        self.max_time = 0
+        self.last_time = 0
+        self.last_run = None
+        self.last_result = None
+
+    def due(self, now):
+        return self.last_run is None or now - self.last_run >= self.interval
+
+    def record(self, now, elapsed, result):
+        self.runs += 1
+        self.last_run = now
+        self.last_time = elapsed
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.last_result = result
+
+
+class MaintenanceScheduler:
+    """Runs SQLite housekeeping on the database thread while Dobby is quiet.
+
+    Every ``tick`` seconds the scheduler counts the database jobs completed
+    since the last tick. If there were at most ``quiet_jobs`` and nothing is
+    queued, the most overdue task is run. Each task keeps to a budget: passive
+    checkpoints never wait on readers, ``PRAGMA optimize`` is capped by
+    ``analysis_limit`` and incremental vacuum frees at most ``vacuum_pages``
+    pages per run. A WAL larger than ``wal_limit`` bytes is checkpointed even
+    when Dobby is busy. With partitions each task runs on every database file
+    through its own writer thread."""
+
+    def __init__(self, tick=30, quiet_jobs=20, checkpoint_interval=300, optimize_interval=6 * 3600,
+                 vacuum_interval=3600, vacuum_pages=256, analysis_limit=1000, wal_limit=64 * 1024 * 1024):
+        self.tick = tick
+        self.quiet_jobs = quiet_jobs
+        self.vacuum_pages = vacuum_pages
+        self.analysis_limit = analysis_limit
+        self.wal_limit = wal_limit
+        self.tasks = {
+            'checkpoint': MaintenanceTask('checkpoint', checkpoint_interval, self._checkpoint),
+            'optimize': MaintenanceTask('optimize', optimize_interval, self._optimize),
+            'vacuum': MaintenanceTask('vacuum', vacuum_interval, self._vacuum)
+        }
+        self.ticks = 0
+        self.busy_ticks = 0
+        self._completed = None
+
+    @staticmethod
+    def _databases():
+        return [DobbyDB] + DobbyDB.partitions
+
+    @property
+    def wal_size(self):
+        size = 0
+        for database in self._databases():
+            try:
+                size += os.path.getsize(database.path + '-wal')
+            except OSError:
+                pass
+        return size
+
+    @staticmethod
+    def _pragma(sql):
+        # partitions have the shared database attached, main keeps each task to its own file
+        return DobbyDB._db.execute_sql(f'PRAGMA main.{sql}').fetchall()
+
+    def _checkpoint(self):
+        busy, log, checkpointed = self._pragma('wal_checkpoint(PASSIVE)')[0]
+        return f'{checkpointed}/{log} frames' + (' (readers active)' if checkpointed < log else '')
+
+    def _optimize(self):
+        if not DobbyDB._db.execute_sql("SELECT 1 FROM main.sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+            # optimize only refreshes stale statistics, the first run gathers them all
+            DobbyDB._db.execute_sql('ANALYZE main')
+            return 'analyzed all tables'
+        self._pragma(f'analysis_limit = {self.analysis_limit}')
+        self._pragma('optimize')
+        return 'optimized'
+
+    def _vacuum(self):
+        if self._pragma('auto_vacuum')[0][0] != 2:
+            return 'skipped, auto_vacuum is not incremental'
+        free = self._pragma('freelist_count')[0][0]
+        if free:
+            self._pragma(f'incremental_vacuum({self.vacuum_pages})')
+        return f'freed {free - self._pragma("freelist_count")[0][0]} of {free} free pages'
+
+    @staticmethod
+    def _full_vacuum():
+        # switching an existing database to incremental auto vacuum takes one full vacuum
+        DobbyDB._db.execute_sql('PRAGMA main.auto_vacuum = INCREMENTAL')
+        DobbyDB._db.execute_sql('VACUUM main')
+
+    def _activity(self):
+        completed = sum(database.stats.completed + database.read_stats.completed for database in self._databases())
+        previous, self._completed = self._completed, completed
+        return completed - previous if previous is not None else 0
+
+    def _queued(self):
+        return any(database.stats.depth or database.read_stats.depth for database in self._databases())
+
+    async def _run_all(self, fn):
+        databases = self._databases()
+        if len(databases) == 1:
+            return await DobbyDB.run(fn)
+        results = []
+        for database in databases:
+            name = os.path.splitext(os.path.basename(database.path))[0]
+            results.append(f'{name}: {await database.run(fn)}')
+        return ', '.join(results)
+
+    async def run_task(self, name):
+        """Runs one task now, regardless of activity, and returns its result."""
+        task = self.tasks[name]
+        start = time.perf_counter()
+        try:
+            result = await self._run_all(task.fn)
+        except Exception as e:
+            task.failed += 1
+            task.last_run = time.monotonic()
+            logger.error(f'Database maintenance {name} failed: {e}')
+            raise
+        elapsed = time.perf_counter() - start
+        task.record(time.monotonic(), elapsed, result)
+        logger.info(f'Database maintenance {name}: {result} in {elapsed * 1000:.1f}ms')
+        return result
+
+    async def full_vacuum(self):
+        """Rewrites the whole database, blocking writes until it's done."""
+        start = time.perf_counter()
+        for database in self._databases():
+            await database.run(self._full_vacuum)
+        return time.perf_counter() - start
+
+    async def step(self):
+        self.ticks += 1
+        now = time.monotonic()
+        activity = self._activity()
+        if activity > self.quiet_jobs or self._queued():
+            self.busy_ticks += 1
+            if self.wal_size > self.wal_limit:
+                await self.run_task('checkpoint')
+            return
+        due = [task for task in self.tasks.values() if task.due(now)]
+        if due:
+            task = min(due, key=lambda t: (t.last_run or 0) + t.interval)
+            await self.run_task(task.name)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.step()
+            except Exception:
+                # run_task has logged it, try again next tick
+                continue
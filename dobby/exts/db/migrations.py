@@ -0,0 +1,167 @@
+import re
+
+from peewee import SQL, Index, Table
+from playhouse.migrate import make_index_name
+
+# (version, function) pairs, applied in version order by DobbyDB.migrate.
+# Each function receives the SqliteMigrator and returns the operations to run.
+# Never edit a migration once it has shipped, add a new version instead.
+MIGRATIONS = []
+
+def migration(version, foreign_keys=True):
+    """Registers a migration.
+
+    Migrations that rebuild a table referenced by foreign keys pass
+    ``foreign_keys=False`` so enforcement is switched off while they run,
+    dropping the old table would fail otherwise."""
+    def decorator(fn):
+        fn.foreign_keys = foreign_keys
+        MIGRATIONS.append((version, fn))
+        return fn
+    return decorator
+
+def _index(migrator, table, columns):
+    # IF NOT EXISTS, some of these match indexes create_tables already made
+    table_obj = Table(table)
+    index = Index(make_index_name(table, columns), table_obj,
+                  [getattr(table_obj.c, column) for column in columns], safe=True)
+    return migrator.make_context().sql(index)
+
+@migration(1)
+def hot_path_indexes(migrator):
+    """Indexes for the location, event and badge lookups."""
+    return [
+        _index(migrator, 'locationtable', ['guild_id', 'name']),
+        _index(migrator, 'locationregionrelation', ['location_id', 'region_id']),
+        _index(migrator, 'locationnotetable', ['location_id']),
+        _index(migrator, 'eventtable', ['guild_id', 'active']),
+        _index(migrator, 'badgeassignmenttable', ['wizard'])
+    ]
+
+def _real_column(migrator, table, column):
+    # rebuilds the table with the column declared REAL, text values that
+    # look like numbers are converted by the column affinity on copy
+    return migrator._update_column(table, column, lambda name, definition: re.sub(
+        r'\bTEXT\b', 'REAL', definition, flags=re.I))
+
+@migration(2, foreign_keys=False)
+def location_coordinates(migrator):
+    """Numeric coordinates and an R*Tree over them for nearby lookups."""
+    return [
+        _real_column(migrator, 'locationtable', 'latitude'),
+        _real_column(migrator, 'locationtable', 'longitude'),
+        SQL('CREATE VIRTUAL TABLE IF NOT EXISTS "locationrtree" '
+            'USING rtree("id", "min_lat", "max_lat", "min_lng", "max_lng")'),
+        SQL('INSERT INTO "locationrtree" SELECT "id", "latitude", "latitude", "longitude", "longitude" '
+            'FROM "locationtable"'),
+        # the rebuild above drops triggers, a later rebuild of locationtable must recreate these
+        SQL('CREATE TRIGGER IF NOT EXISTS "locationtable_rtree_insert" AFTER INSERT ON "locationtable" BEGIN '
+            'INSERT INTO "locationrtree" VALUES (new."id", new."latitude", new."latitude", '
+            'new."longitude", new."longitude"); END'),
+        SQL('CREATE TRIGGER IF NOT EXISTS "locationtable_rtree_update" AFTER UPDATE OF "latitude", "longitude" '
+            'ON "locationtable" BEGIN '
+            'UPDATE "locationrtree" SET "min_lat" = new."latitude", "max_lat" = new."latitude", '
+            '"min_lng" = new."longitude", "max_lng" = new."longitude" WHERE "id" = new."id"; END'),
+        SQL('CREATE TRIGGER IF NOT EXISTS "locationtable_rtree_delete" AFTER DELETE ON "locationtable" BEGIN '
+            'DELETE FROM "locationrtree" WHERE "id" = old."id"; END')
+    ]
+
+_SEARCH_COLUMNS = {
+    'notes': 'SELECT group_concat("note", \' \') FROM "locationnotetable" WHERE "location_id" = {id}',
+    'regions': 'SELECT group_concat(r."name", \' \') FROM "locationregionrelation" AS lr '
+               'JOIN "regiontable" AS r ON r."id" = lr."region_id" WHERE lr."location_id" = {id}'
+}
+
+def _refresh_search(column, location_id):
+    select = _SEARCH_COLUMNS[column].format(id=location_id)
+    return f'UPDATE "locationsearch" SET "{column}" = ({select}) WHERE "rowid" = {location_id};'
+
+def _trigger(name, event, table, body):
+    return SQL(f'CREATE TRIGGER IF NOT EXISTS "{name}" AFTER {event} ON "{table}" BEGIN {body} END')
+
+@migration(3)
+def location_search(migrator):
+    """FTS5 index over location names, notes and region names."""
+    return [
+        SQL('CREATE VIRTUAL TABLE IF NOT EXISTS "locationsearch" '
+            'USING fts5("name", "notes", "regions", prefix=\'2 3\')'),
+        SQL('INSERT INTO "locationsearch" ("rowid", "name", "notes", "regions") '
+            'SELECT l."id", l."name", ({notes}), ({regions}) FROM "locationtable" AS l'.format(
+                notes=_SEARCH_COLUMNS['notes'].format(id='l."id"'),
+                regions=_SEARCH_COLUMNS['regions'].format(id='l."id"'))),
+        # the rebuild in migration 2 drops triggers, a later rebuild of these tables must recreate them
+        _trigger('locationtable_search_insert', 'INSERT', 'locationtable',
+                 'INSERT INTO "locationsearch" ("rowid", "name") VALUES (new."id", new."name");'),
+        _trigger('locationtable_search_update', 'UPDATE OF "name"', 'locationtable',
+                 'UPDATE "locationsearch" SET "name" = new."name" WHERE "rowid" = new."id";'),
+        _trigger('locationtable_search_delete', 'DELETE', 'locationtable',
+                 'DELETE FROM "locationsearch" WHERE "rowid" = old."id";'),
+        _trigger('locationnotetable_search_insert', 'INSERT', 'locationnotetable',
+                 _refresh_search('notes', 'new."location_id"')),
+        _trigger('locationnotetable_search_update', 'UPDATE', 'locationnotetable',
+                 _refresh_search('notes', 'old."location_id"') + _refresh_search('notes', 'new."location_id"')),
+        _trigger('locationnotetable_search_delete', 'DELETE', 'locationnotetable',
+                 _refresh_search('notes', 'old."location_id"')),
+        _trigger('locationregionrelation_search_insert', 'INSERT', 'locationregionrelation',
+                 _refresh_search('regions', 'new."location_id"')),
+        _trigger('locationregionrelation_search_update', 'UPDATE', 'locationregionrelation',
+                 _refresh_search('regions', 'old."location_id"') + _refresh_search('regions', 'new."location_id"')),
+        _trigger('locationregionrelation_search_delete', 'DELETE', 'locationregionrelation',
+                 _refresh_search('regions', 'old."location_id"'))
+    ]
+
+def _add_column(migrator, table, column, definition):
+    # create_tables already adds the column on a fresh database
+    if column in [c.name for c in migrator.database.get_columns(table)]:
+        return []
+    return [SQL(f'ALTER TABLE "{table}" ADD COLUMN "{column}" {definition}')]
+
+# one row per wizard and one for the guild total (wizard 0) in each bucket
+_LEADERBOARD_ROWS = (
+    'SELECT \'{kind}\', {guild}, CASE w."column1" WHEN 1 THEN {row}."wizard" ELSE 0 END, p."column1", '
+    'CASE p."column1" WHEN \'day\' THEN date({row}."created") '
+    'WHEN \'week\' THEN date({row}."created", \'-6 days\', \'weekday 1\') ELSE \'\' END AS "bucket", {total} '
+    'FROM {source}(VALUES (0), (1)) AS w, (VALUES (\'day\'), (\'week\'), (\'all\')) AS p '
+    'WHERE "bucket" IS NOT NULL AND {guild} IS NOT NULL{join}')
+
+_LEADERBOARD_KINDS = {
+    'reports': ('wizardreportrelation', '"locationtable" AS l, ', 'l."guild_id"', ' AND l."id" = {row}."location_id"'),
+    'badges': ('badgeassignmenttable', '', '{row}."guild"', '')
+}
+
+def _leaderboard_rows(kind, row, total, source=''):
+    __, tables, guild, join = _LEADERBOARD_KINDS[kind]
+    return _LEADERBOARD_ROWS.format(kind=kind, row=row, total=total, source=source + tables,
+                                    guild=guild.format(row=row), join=join.format(row=row))
+
+def _leaderboard_trigger(kind, event, row, total):
+    table = _LEADERBOARD_KINDS[kind][0]
+    return _trigger(f'{table}_leaderboard_{event.lower()}', event, table,
+                    'INSERT INTO "leaderboardtable" ("kind", "guild", "wizard", "period", "bucket", "total") '
+                    f'{_leaderboard_rows(kind, row, total)} ON CONFLICT ("kind", "guild", "period", "bucket", "wizard") '
+                    'DO UPDATE SET "total" = "total" + excluded."total";')
+
+def leaderboard_fill():
+    """Recounts the leaderboard summaries from the report and badge tables."""
+    statements = [SQL('DELETE FROM "leaderboardtable"')]
+    for kind, (table, __, __, __) in _LEADERBOARD_KINDS.items():
+        rows = _leaderboard_rows(kind, 't', 'count(*)', source=f'"{table}" AS t, ')
+        statements.append(SQL('INSERT INTO "leaderboardtable" ("kind", "guild", "wizard", "period", "bucket", "total") '
+                              f'{rows} GROUP BY 1, 2, 3, 4, 5'))
+    return statements
+
+@migration(4)
+def leaderboards(migrator):
+    """Per wizard and per guild report and badge counts, kept current by triggers."""
+    return [
+        *_add_column(migrator, 'badgeassignmenttable', 'guild', 'INTEGER'),
+        *_add_column(migrator, 'badgeassignmenttable', 'created', 'DATETIME'),
+        # badges granted before this have no guild, credit the first guild the wizard is registered in
+        SQL('UPDATE "badgeassignmenttable" SET "guild" = (SELECT min(w."guild_id") FROM "wizardtable" AS w '
+            'WHERE w."snowflake" = "badgeassignmenttable"."wizard") WHERE "guild" IS NULL'),
+        _leaderboard_trigger('reports', 'INSERT', 'new', 1),
+        _leaderboard_trigger('reports', 'DELETE', 'old', -1),
+        _leaderboard_trigger('badges', 'INSERT', 'new', 1),
+        _leaderboard_trigger('badges', 'DELETE', 'old', -1),
+        *leaderboard_fill()
+    ]
@@ -0,0 +1,155 @@
+import datetime
+import json
+import logging
+import re
+import threading
+import time
+
+from playhouse.apsw_ext import APSWDatabase
+
+logger = logging.getLogger('dobby')
+
+# upper bounds of the latency histogram buckets in milliseconds
+BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, float('inf'))
+
+_PLANNED = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+
+def query_shape(sql):
+    """Collapses placeholder lists so multi-row inserts and IN lists of any length share a shape."""
+    sql = re.sub(r'\(\?(?:, \?)+\)', '(?)', sql.strip())
+    return re.sub(r'\(\?\)(?:, \(\?\))+', '(?), ...', sql)
+
+
+class QueryShapeStats:
+    def __init__(self, shape):
+        self.shape = shape
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.slow = 0
+        self.histogram = [0] * len(BUCKETS)
+        self.plan = None
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, q):
+        """Upper bound in milliseconds of the bucket holding the q-th fraction of calls."""
+        seen = 0
+        for bound, count in zip(BUCKETS, self.histogram):
+            seen += count
+            if count and seen >= q * self.count:
+                return bound if bound != float('inf') else self.max * 1000
+        return 0
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        ms = elapsed * 1000
+        self.histogram[next(i for i, bound in enumerate(BUCKETS) if ms <= bound)] += 1
+
+    def to_dict(self):
+        return {
+            'shape': self.shape,
+            'count': self.count,
+            'total_ms': self.total * 1000,
+            'avg_ms': self.average * 1000,
+            'max_ms': self.max * 1000,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'slow': self.slow,
+            'histogram': {str(bound): count for bound, count in zip(BUCKETS, self.histogram)},
+            'plan': self.plan
+        }
+
+
+class QueryProfiler:
+    """Times every statement run on the connections it is attached to.
+
+    Timing starts in the APSW exec trace and stops in the SQLite profile
+    callback, so a SELECT includes the time spent stepping through its rows.
+    Statements slower than ``threshold`` seconds are logged with their
+    EXPLAIN QUERY PLAN, which is also kept for the dump."""
+
+    def __init__(self, threshold=0.1, enabled=True):
+        self.threshold = threshold
+        self.enabled = enabled
+        self.shapes = {}
+        self.since = datetime.datetime.utcnow()
+        self._lock = threading.Lock()
+        self._started = threading.local()
+
+    def attach(self, conn):
+        conn.setexectrace(self._exec)
+        conn.setprofile(lambda sql, nanoseconds: self._profile(conn, sql, nanoseconds))
+
+    def _exec(self, cursor, sql, bindings):
+        if self.enabled:
+            if not hasattr(self._started, 'statements'):
+                self._started.statements = {}
+            self._started.statements[sql] = (time.perf_counter(), bindings)
+        return True
+
+    def _profile(self, conn, sql, nanoseconds):
+        started = getattr(self._started, 'statements', {}).pop(sql, None)
+        if not self.enabled or sql.startswith('EXPLAIN'):
+            return
+        if started:
+            elapsed = time.perf_counter() - started[0]
+        else:
+            elapsed = nanoseconds / 1e9
+        shape = query_shape(sql)
+        with self._lock:
+            stats = self.shapes.get(shape)
+            if stats is None:
+                stats = self.shapes[shape] = QueryShapeStats(shape)
+            stats.add(elapsed)
+            if elapsed >= self.threshold:
+                stats.slow += 1
+        if elapsed >= self.threshold and shape.upper().startswith(_PLANNED):
+            plan = self._explain(conn, sql, started[1] if started else None)
+            stats.plan = plan
+            logger.warning(f'Slow query {elapsed * 1000:.1f}ms: {sql}\n' + '\n'.join(plan))
+
+    @staticmethod
+    def _explain(conn, sql, bindings):
+        try:
+            return [row[-1] for row in conn.cursor().execute('EXPLAIN QUERY PLAN ' + sql, bindings)]
+        except Exception as e:
+            return [f'plan unavailable: {e}']
+
+    def snapshot(self):
+        """Returns the per shape stats as dicts, most total time first."""
+        with self._lock:
+            result = [stats.to_dict() for stats in self.shapes.values()]
+        return sorted(result, key=lambda s: -s['total_ms'])
+
+    def dump(self):
+        return json.dumps({
+            'since': self.since.isoformat(),
+            'generated': datetime.datetime.utcnow().isoformat(),
+            'threshold_ms': self.threshold * 1000,
+            'buckets_ms': [str(bound) for bound in BUCKETS],
+            'queries': self.snapshot()
+        }, indent=2)
+
+    def reset(self):
+        with self._lock:
+            self.shapes = {}
+            self.since = datetime.datetime.utcnow()
+
+
+class InstrumentedAPSWDatabase(APSWDatabase):
+    """APSWDatabase whose connections report to a QueryProfiler."""
+
+    def __init__(self, database, profiler=None, **kwargs):
+        self.profiler = profiler
+        super().__init__(database, **kwargs)
+
+    def _add_conn_hooks(self, conn):
+        super()._add_conn_hooks(conn)
+        if self.profiler is not None:
+            self.profiler.attach(conn)
@@ -0,0 +1,121 @@
+import json
+import threading
+import time
+
+from peewee import SQL, Value
+
+
+class Param:
+    """Placeholder for a value bound each time a template runs."""
+
+    def __init__(self, name):
+        self.name = name
+
+
+def param(name):
+    return Value(Param(name), converter=False)
+
+
+def param_list(name):
+    """Placeholder for a list of values, bound as a json array.
+
+    Use with ``in_`` so a template doesn't need one variant per list length."""
+    return SQL('(SELECT value FROM json_each(?))', [Param(name)])
+
+
+class QueryTemplate:
+    """A peewee query whose SQL is generated once and rerun with new parameters.
+
+    ``build`` receives a placeholder for each parameter name and returns the
+    query. Rows come back the same way the built query would return them, so
+    ``.objects()``, ``.dicts()`` and model rows all work."""
+
+    def __init__(self, name, build, params):
+        self.name = name
+        self.build = build
+        self.params = params
+        self.query = None
+        self.sql = None
+        self.values = None
+        self.calls = 0
+        self.generate_time = 0
+        self.execute_time = 0
+        self._lock = threading.Lock()
+
+    def compile(self):
+        start = time.perf_counter()
+        query = self.build(*[param(name) if not name.endswith('[]') else param_list(name[:-2])
+                             for name in self.params])
+        self.sql, self.values = query.sql()
+        self.query = query
+        self.generate_time = time.perf_counter() - start
+
+    def bind(self, params):
+        return [params[value.name] if isinstance(value, Param) else value for value in self.values]
+
+    def execute(self, database, params):
+        if self.query is None:
+            self.compile()
+        start = time.perf_counter()
+        cursor = database.execute_sql(self.sql, self.bind(params))
+        rows = list(self.query._get_cursor_wrapper(cursor))
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.calls += 1
+            self.execute_time += elapsed
+        return rows
+
+
+class QueryTemplateRegistry:
+    """Named query templates for the bot's hottest lookups."""
+
+    def __init__(self, database):
+        self.database = database
+        self.templates = {}
+
+    def register(self, name, build, *params):
+        """Adds or replaces a template.
+
+        Parameter names ending in ``[]`` are lists, bound as json arrays."""
+        self.templates[name] = QueryTemplate(name, build, params)
+
+    def run(self, name, **params):
+        """Runs a template on the calling thread and returns its rows."""
+        template = self.templates[name]
+        for key in [key for key in params if isinstance(params[key], (list, tuple, set))]:
+            params[key] = json.dumps(list(params[key]))
+        return template.execute(self.database, params)
+
+    def first(self, name, **params):
+        rows = self.run(name, **params)
+        return rows[0] if rows else None
+
+    def explain(self, name):
+        """Returns the EXPLAIN QUERY PLAN detail lines for a template."""
+        template = self.templates[name]
+        if template.query is None:
+            template.compile()
+        values = [None if isinstance(value, Param) else value for value in template.values]
+        cursor = self.database.execute_sql('EXPLAIN QUERY PLAN ' + template.sql, values)
+        return [row[-1] for row in cursor]
+
+    def full_scans(self):
+        """Returns ``(name, detail)`` for every plan step that reads a whole table without an index."""
+        result = []
+        for name in self.templates:
+            for detail in self.explain(name):
+                if detail.startswith('SCAN') and not any(word in detail for word in ('USING', 'VIRTUAL', 'CONSTANT')):
+                    result.append((name, detail))
+        return result
+
+    def stats(self):
+        """Returns ``(name, calls, generate_s, average_execute_s, saved_s)`` per template.
+
+        ``saved_s`` estimates the SQL generation time saved by not rebuilding
+        the query on every call after the first."""
+        result = []
+        for template in self.templates.values():
+            average = template.execute_time / template.calls if template.calls else 0
+            saved = template.generate_time * max(template.calls - 1, 0)
+            result.append((template.name, template.calls, template.generate_time, average, saved))
+        return result
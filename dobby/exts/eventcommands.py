@@ -7,13 +7,16 @@ from discord.ext import commands
 import peewee
 
 from dobby import utils, checks
-from dobby.exts.db.dobbydb import EventTable, GuildTable
+from dobby.exts.db.dobbydb import DobbyDB, EventTable, GuildTable
 
 class EventCommands(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.failed_react = '❌'
         self.success_react = '✅'
+        DobbyDB.queries.register('active_events', lambda guild: (
+            EventTable.select(EventTable.role).where((EventTable.active == True) & (EventTable.guild_id == guild))),
+            'guild')
 
     @commands.command(name='checkin', aliases=['ch', 'ci'], case_insensitive=True)
     @commands.has_permissions(manage_roles=True)
@@ -23,9 +26,7 @@ class EventCommands(commands.Cog):
             member = await converter.convert(ctx, member)
         except:
             member = None
-        result = (EventTable.select(EventTable.role)
-                            .where((EventTable.active == True) &
-                                   (EventTable.guild_id == member.guild.id)))
+        result = await DobbyDB.guild(member.guild.id).read(DobbyDB.queries.run, 'active_events', guild=member.guild.id)
         roles = [r.role for r in result]
         if len(roles) < 1:
             await ctx.message.add_reaction(self.failed_react)
@@ -63,7 +64,8 @@ class EventCommands(commands.Cog):
         if not role:
             return
         try:
-            event, __ = EventTable.get_or_create(guild=ctx.guild.id, eventname=name, active=False, role=role.id)
+            event, __ = await DobbyDB.guild(ctx.guild.id).run(EventTable.get_or_create, guild=ctx.guild.id,
+                                                             eventname=name, active=False, role=role.id)
             if event:
                 message = f"Event **{name}** successfully created with role: **{role.name}**."
                 colour = discord.Colour.green()
@@ -87,7 +89,8 @@ class EventCommands(commands.Cog):
             return await ctx.send("Please provide both the current event name and a new event name.", delete_after=10)
         oldname = info[0]
         newname = info[1]
-        updated = EventTable.update(eventname=newname).where(EventTable.eventname==oldname).execute()
+        updated = await DobbyDB.guild(ctx.guild.id).run(
+            EventTable.update(eventname=newname).where(EventTable.eventname==oldname).execute)
         if updated == 0:
             message = "No event found by that name."
             colour = discord.Colour.red()
@@ -113,7 +116,8 @@ class EventCommands(commands.Cog):
         role = await self._validate_role(ctx, info[1])
         if not role:
             return
-        updated = EventTable.update(role=role.id).where(EventTable.eventname==name).execute()
+        updated = await DobbyDB.guild(ctx.guild.id).run(
+            EventTable.update(role=role.id).where(EventTable.eventname==name).execute)
         if updated == 0:
             message = "No event found by that name."
             colour = discord.Colour.red()
@@ -131,9 +135,10 @@ class EventCommands(commands.Cog):
 
     @_event.command(name='set_active', aliases=['set', 'sa'], case_insensitive=True)
     async def _set_active(self, ctx, *, name):
-        count = EventTable.update(active=True).where(EventTable.eventname == name).execute()
+        database = DobbyDB.guild(ctx.guild.id)
+        count = await database.run(EventTable.update(active=True).where(EventTable.eventname == name).execute)
         if count == 1:
-            EventTable.update(active=False).where(EventTable.eventname != name).execute()
+            await database.run(EventTable.update(active=False).where(EventTable.eventname != name).execute)
             message = f"Successfully set active event to **{name}**"
             colour = discord.Colour.green()
             reaction = self.success_react
@@ -142,7 +147,7 @@ class EventCommands(commands.Cog):
             colour = discord.Colour.red()
             reaction = self.failed_react
         else:
-            EventTable.update(active=False).execute()
+            await database.run(EventTable.update(active=False).execute)
             message = "Something went wrong, all events are now inactive."
             colour = discord.Colour.red()
             reaction = self.failed_react
@@ -166,6 +171,7 @@ class EventCommands(commands.Cog):
             active_str = "Active"
         else:
             active_str = "All"
+        result = await DobbyDB.guild(ctx.guild.id).read(list, result)
         if len(result) == 0:
             await ctx.message.add_reaction(self.failed_react)
             return await ctx.send(f"No {active_str} events found.")
@@ -0,0 +1,51 @@
+import time
+
+import discord
+from discord.ext import commands
+
+from dobby import checks
+from dobby.exts.db.dobbydb import DobbyDB, LeaderboardTable
+
+
+class Leaderboards(commands.Cog):
+    kinds = {'reports': 'Reporters', 'badges': 'Badge Earners'}
+    periods = {'day': 'Today', 'week': 'This Week', 'all': 'All Time'}
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.group(name='leaderboard', aliases=['lb'], case_insensitive=True, invoke_without_command=True)
+    async def _leaderboard(self, ctx, kind='reports', period='week'):
+        """**Usage**: `!leaderboard/lb [reports/badges] [day/week/all]`
+        Shows the top 10 wizards of this server for the period, this week by default."""
+        kind, period = kind.lower(), period.lower()
+        if kind not in self.kinds or period not in self.periods:
+            await ctx.message.add_reaction(self.bot.failed_react)
+            return await ctx.send("Usage: `!leaderboard [reports/badges] [day/week/all]`", delete_after=10)
+        rows = await DobbyDB.guild(ctx.guild.id).read(DobbyDB.queries.run, 'leaderboard', kind=kind, guild=ctx.guild.id,
+                                                   period=period, bucket=LeaderboardTable.bucket_for(period), limit=11)
+        guild_total = next((r.total for r in rows if r.wizard == 0), 0)
+        lines = []
+        for row in [r for r in rows if r.wizard != 0 and r.total > 0][:10]:
+            member = ctx.guild.get_member(row.wizard)
+            name = member.display_name if member else f'<@{row.wizard}>'
+            lines.append(f"**{len(lines) + 1}.** {name} - {row.total}")
+        embed = discord.Embed(title=f"Top {self.kinds[kind]} - {self.periods[period]}", colour=ctx.guild.me.colour,
+                              description='\n'.join(lines) or "Nothing recorded yet.")
+        embed.set_footer(text=f"{guild_total} {kind} on this server")
+        await ctx.send(embed=embed)
+
+    @_leaderboard.command(name='rebuild', hidden=True)
+    @checks.is_owner()
+    async def _rebuild(self, ctx):
+        """**Usage**: `!leaderboard rebuild`
+        Recounts every leaderboard from the report and badge tables."""
+        start = time.perf_counter()
+        rows = 0
+        for database in DobbyDB.handles():
+            rows += await database.run(LeaderboardTable.rebuild)
+        await ctx.send(f"Leaderboards rebuilt, {rows} rows in {time.perf_counter() - start:.2f}s.")
+
+
+def setup(bot):
+    bot.add_cog(Leaderboards(bot))
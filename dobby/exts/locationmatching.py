@@ -1,8 +1,10 @@
 import datetime
+import functools
 import json
 import os
 import tempfile
 
+import discord
 from discord.ext import commands
 
 from dobby import utils, checks
@@ -52,54 +54,42 @@ class Greenhouse(Location):
 class LocationMatching(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        for table, location_class in ((FortressTable, Fortress), (InnTable, Inn), (GreenhouseTable, Greenhouse)):
+            name = location_class.__name__.lower()
+            DobbyDB.queries.register(name, functools.partial(self._locations_query, table, location_class),
+                                     'guild')
+            DobbyDB.queries.register(f'{name}_in_regions',
+                                     functools.partial(self._locations_query, table, location_class),
+                                     'guild', 'regions[]')
+        DobbyDB.queries.register('location_search', self._search_query, 'guild', 'match', 'limit')
 
-    def get_all(self, guild_id, regions=None):
-        return self.get_fortresses(guild_id, regions=regions) + self.get_inns(guild_id, regions=regions) + self.get_greenhouses(guild_id, regions=regions)
-    
-    def get_fortresses(self, guild_id, regions=None):
-        result = (FortressTable
-                    .select(LocationTable.id,
-                            LocationTable.name, 
-                            LocationTable.latitude, 
-                            LocationTable.longitude, 
-                            RegionTable.name.alias('region'),
-                            LocationNoteTable.note)
-                    .join(LocationTable)
-                    .join(LocationRegionRelation)
-                    .join(RegionTable)
-                    .join(LocationNoteTable, JOIN.LEFT_OUTER, on=(LocationNoteTable.location_id == LocationTable.id))
-                    .where((LocationTable.guild == guild_id) &
-                           (LocationTable.guild == RegionTable.guild)))
-        if regions:
-            if not isinstance(regions, list):
-                regions = [regions]
-            result = result.where(RegionTable.name << regions)
-        result = result.objects(Fortress)
-        return [o for o in result]
+    async def get_all(self, guild_id, regions=None):
+        def query():
+            return (self._get_locations(Fortress, guild_id, regions)
+                    + self._get_locations(Inn, guild_id, regions)
+                    + self._get_locations(Greenhouse, guild_id, regions))
+        return await DobbyDB.guild(guild_id).read(query)
 
-    def get_inns(self, guild_id, regions=None):
-        result = (InnTable
-                    .select(LocationTable.id,
-                            LocationTable.name, 
-                            LocationTable.latitude, 
-                            LocationTable.longitude, 
-                            RegionTable.name.alias('region'),
-                            LocationNoteTable.note)
-                    .join(LocationTable)
-                    .join(LocationRegionRelation)
-                    .join(RegionTable)
-                    .join(LocationNoteTable, JOIN.LEFT_OUTER, on=(LocationNoteTable.location_id == LocationTable.id))
-                    .where((LocationTable.guild == guild_id) &
-                           (LocationTable.guild == RegionTable.guild)))
-        if regions:
-            if not isinstance(regions, list):
-                regions = [regions]
-            result = result.where(RegionTable.name << regions)
-        result = result.objects(Inn)
-        return [o for o in result]
+    async def get_fortresses(self, guild_id, regions=None):
+        return await DobbyDB.guild(guild_id).read(self._get_locations, Fortress, guild_id, regions)
+
+    async def get_inns(self, guild_id, regions=None):
+        return await DobbyDB.guild(guild_id).read(self._get_locations, Inn, guild_id, regions)
 
-    def get_greenhouses(self, guild_id, regions=None):
-        result = (GreenhouseTable
+    async def get_greenhouses(self, guild_id, regions=None):
+        return await DobbyDB.guild(guild_id).read(self._get_locations, Greenhouse, guild_id, regions)
+
+    def _get_locations(self, location_class, guild_id, regions=None):
+        name = location_class.__name__.lower()
+        if not regions:
+            return DobbyDB.queries.run(name, guild=guild_id)
+        if not isinstance(regions, list):
+            regions = [regions]
+        return DobbyDB.queries.run(f'{name}_in_regions', guild=guild_id, regions=regions)
+
+    @staticmethod
+    def _locations_query(table, location_class, guild_id, regions=None):
+        result = (table
                     .select(LocationTable.id,
                             LocationTable.name, 
                             LocationTable.latitude, 
@@ -112,12 +102,42 @@ class LocationMatching(commands.Cog):
                     .join(LocationNoteTable, JOIN.LEFT_OUTER, on=(LocationNoteTable.location_id == LocationTable.id))
                     .where((LocationTable.guild == guild_id) &
                            (LocationTable.guild == RegionTable.guild)))
-        if regions:
-            if not isinstance(regions, list):
-                regions = [regions]
+        if regions is not None:
             result = result.where(RegionTable.name << regions)
-        result = result.objects(Greenhouse)
-        return [o for o in result]
+        return result.objects(location_class)
+
+    @staticmethod
+    def _search_query(guild_id, match, limit):
+        return (LocationSearch
+                .select(LocationTable.id,
+                        LocationTable.name,
+                        LocationSearch.regions,
+                        LocationSearch.notes,
+                        LocationSearch.bm25(10.0, 1.0, 2.0).alias('score'))
+                .join(LocationTable, on=(LocationTable.id == LocationSearch.rowid))
+                .where(LocationSearch.match(match) & (LocationTable.guild == guild_id))
+                .order_by(SQL('score'))
+                .limit(limit)
+                .dicts())
+
+    async def search(self, guild_id, text, limit=10, operator='AND'):
+        """Full-text search over location names, notes and regions, best bm25 match first."""
+        match = LocationSearch.prefix_query(text, operator)
+        if not match:
+            return []
+        return await DobbyDB.guild(guild_id).read(DobbyDB.queries.run, 'location_search',
+                                                  guild=guild_id, match=match, limit=limit)
+
+    async def shortlist(self, guild_id, name, locations):
+        """Narrows a large guild's locations to those sharing a word prefix with name.
+
+        Returns locations unchanged when the guild is small or nothing matches,
+        fuzzy matching covers typos the index can't."""
+        if len(locations) < self.bot.config.get('location_shortlist_threshold', 500):
+            return locations
+        rows = await self.search(guild_id, name, limit=self.bot.config.get('location_shortlist_size', 50), operator='OR')
+        ids = {row['id'] for row in rows}
+        return [l for l in locations if l.id in ids] or locations
 
     def location_match(self, name, locations, threshold=75, isPartial=True, limit=None):
         match = utils.get_match([l.name for l in locations], name, threshold, isPartial, limit)
@@ -136,18 +156,20 @@ class LocationMatching(commands.Cog):
             return await ctx.send('Type and name are required')
         loc_type = loc_type.lower()
         if 'inn' in loc_type:
-            locations = self.get_inns(ctx.guild.id, regions)
+            locations = await self.get_inns(ctx.guild.id, regions)
         elif 'greenhouse' in loc_type:
-            locations = self.get_greenhouses(ctx.guild.id, regions)
+            locations = await self.get_greenhouses(ctx.guild.id, regions)
         elif loc_type.startswith('fortress'):
-            locations = self.get_fortresses(ctx.guild.id, regions)
+            locations = await self.get_fortresses(ctx.guild.id, regions)
         else:
             add_prefix = True
-            locations = self.get_all(ctx.guild.id, regions)
+            locations = await self.get_all(ctx.guild.id, regions)
         if not locations:
             await ctx.send('Location matching has not been set up for this server.')
             return        
-        result = self.location_match(name, locations)
+        result = self.location_match(name, await self.shortlist(ctx.guild.id, name, locations))
+        if not result:
+            result = self.location_match(name, locations)
         if not result:
             result = 'No matches found!'
         else:
@@ -155,6 +177,26 @@ class LocationMatching(commands.Cog):
         for i in range(len(result) // 2001 + 1):
             await ctx.send(result[2001*i:2001*(i+1)])
     
+    @commands.command(name='locsearch', aliases=['lsearch'])
+    async def _locsearch(self, ctx, *, text):
+        """Searches location names, notes and regions.
+
+        Usage: !locsearch <words>
+        Every word must match the start of a word in the name, notes or region."""
+        rows = await self.search(ctx.guild.id, text)
+        if not rows:
+            return await ctx.send(f"No locations found matching '{text}'.")
+        lines = []
+        for row in rows:
+            line = f"**{row['name']}**"
+            if row['regions']:
+                line += f" ({row['regions']})"
+            if row['notes']:
+                line += f"\n    {row['notes'][:100]}"
+            lines.append(line)
+        await ctx.send(embed=discord.Embed(colour=discord.Colour.purple(), title=f"Locations matching '{text}'",
+                                           description='\n'.join(lines)))
+
     def _get_location_info_output(self, result, locations):
         match, score = result
         location_info = locations[match]
@@ -0,0 +1,134 @@
+import csv
+import json
+
+LOCATION_TYPES = ('fortress', 'inn', 'greenhouse')
+
+
+class LocationImportError(Exception):
+    """Raised when an import file can't be read any further."""
+
+
+def read_csv(fd):
+    """Yields ``(row, fields)`` for each line of a csv export.
+
+    The first line must be a header naming at least the type, name, region,
+    latitude and longitude columns. A notes column is optional. Multiple
+    regions or notes are separated by ``|``."""
+    reader = csv.DictReader(fd)
+    try:
+        reader.fieldnames
+    except csv.Error as e:
+        raise LocationImportError(f'CSV header: {e}')
+    columns = {column.strip().lower() for column in reader.fieldnames or []}
+    missing = {'type', 'name', 'region', 'latitude', 'longitude'} - columns
+    if missing:
+        raise LocationImportError(f"CSV header is missing {', '.join(sorted(missing))}")
+    while True:
+        try:
+            fields = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            raise LocationImportError(f'CSV line {reader.line_num}: {e}')
+        fields = {(key or '').strip().lower(): (value or '').strip() for key, value in fields.items()
+                  if isinstance(value, str)}
+        notes = fields.get('notes')
+        fields['notes'] = [note.strip() for note in notes.split('|') if note.strip()] if notes else []
+        yield reader.line_num, fields
+
+
+def _scan_features(fd, chunk_size):
+    """Yields the objects of the top level ``features`` array one at a time.
+
+    Only the current feature is held in memory, so large FeatureCollections
+    can be read without decoding the whole document."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    eof = False
+
+    def fill():
+        nonlocal buffer, eof
+        chunk = fd.read(chunk_size)
+        if not chunk:
+            eof = True
+        buffer += chunk
+
+    while True:
+        start = buffer.find('"features"')
+        if start != -1:
+            bracket = buffer.find('[', start)
+            if bracket != -1:
+                buffer = buffer[bracket + 1:]
+                break
+        if eof:
+            raise LocationImportError('GeoJSON file has no features array')
+        fill()
+    while True:
+        pos = 0
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        buffer = buffer[pos:]
+        if not buffer:
+            if eof:
+                raise LocationImportError('GeoJSON features array is not closed')
+            fill()
+            continue
+        if buffer[0] == ']':
+            return
+        try:
+            feature, end = decoder.raw_decode(buffer)
+        except ValueError:
+            if eof:
+                raise LocationImportError('GeoJSON file is truncated or malformed')
+            fill()
+            continue
+        buffer = buffer[end:]
+        yield feature
+
+
+def read_geojson(fd, chunk_size=65536):
+    """Yields ``(row, fields)`` for each Point feature of a GeoJSON FeatureCollection.
+
+    Feature properties supply the type, name, region and notes, the geometry
+    supplies the coordinates."""
+    for row, feature in enumerate(_scan_features(fd, chunk_size), 1):
+        fields = {}
+        if isinstance(feature, dict):
+            properties = feature.get('properties') or {}
+            fields = {key.lower(): value for key, value in properties.items()}
+            geometry = feature.get('geometry') or {}
+            if geometry.get('type') == 'Point' and len(geometry.get('coordinates') or []) >= 2:
+                fields['longitude'], fields['latitude'] = geometry['coordinates'][:2]
+        notes = fields.get('notes') or []
+        fields['notes'] = [notes] if isinstance(notes, str) else notes
+        yield row, fields
+
+
+def validate(fields, regions, existing):
+    """Checks one parsed row and returns ``(name, data, type)`` for the location loader.
+
+    ``regions`` are the guild's region names and ``existing`` the location
+    names already present. Raises ValueError describing the first problem found."""
+    type = str(fields.get('type') or '').lower()
+    if type not in LOCATION_TYPES:
+        raise ValueError(f"unknown type '{fields.get('type') or ''}'")
+    name = str(fields.get('name') or '').strip()
+    if not name:
+        raise ValueError('missing name')
+    if name.lower() in existing:
+        raise ValueError(f"'{name}' already exists")
+    # a location in several regions lists them separated by |, the way exports write them
+    names = [region.strip().lower() for region in str(fields.get('region') or '').split('|') if region.strip()]
+    for region in names or ['']:
+        if region not in regions:
+            raise ValueError(f"unknown region '{region}'")
+    try:
+        latitude = float(fields.get('latitude'))
+        longitude = float(fields.get('longitude'))
+    except (TypeError, ValueError):
+        raise ValueError('coordinates are not numbers')
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        raise ValueError(f'coordinates {latitude},{longitude} are out of range')
+    notes = [str(note) for note in fields.get('notes') or []]
+    data = {'coordinates': f'{latitude},{longitude}', 'region': ','.join(names), 'notes': notes}
+    return name, data, type
@@ -0,0 +1,195 @@
+import asyncio
+import collections
+import datetime
+import logging
+import time
+
+from peewee import IntegrityError, chunked
+
+from dobby.exts.db.dobbydb import DobbyDB, LocationLoader, LocationTable, WizardReportRelation
+
+logger = logging.getLogger('dobby')
+
+
+class IngestStats:
+    """Counters for the report ingestion pipeline."""
+
+    def __init__(self):
+        self.accepted = 0
+        self.duplicates = 0
+        self.written = 0
+        self.failed_batches = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.batches = 0
+        self.last_batch = 0
+        self.max_batch = 0
+        self.last_lag = 0
+        self.max_lag = 0
+        self.total_lag = 0
+
+    @property
+    def average_batch(self):
+        return self.written / self.batches if self.batches else 0
+
+    @property
+    def average_lag(self):
+        return self.total_lag / self.written if self.written else 0
+
+    def record(self, size, lags):
+        self.batches += 1
+        self.written += size
+        self.last_batch = size
+        self.max_batch = max(self.max_batch, size)
+        self.last_lag = max(lags)
+        self.max_lag = max(self.max_lag, self.last_lag)
+        self.total_lag += sum(lags)
+
+
+class ReportIngestor:
+    """Queues location reports in memory and writes them to WizardReportRelation in batches.
+
+    A report for the same wizard and location within ``dedupe_window`` seconds
+    of an accepted one is dropped. ``run`` writes whatever is queued every
+    ``interval`` seconds, at most ``max_batch`` reports per transaction.
+
+    When a batch fails its reports are written one at a time instead. Reports
+    the database rejects, such as one for a location deleted since, are
+    dropped and the rest are retried on later flushes, up to ``max_attempts``
+    times, behind which newer reports keep being written."""
+
+    def __init__(self, interval=0.25, dedupe_window=300, max_batch=1000, max_attempts=5):
+        self.interval = interval
+        self.dedupe_window = dedupe_window
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts
+        self.stats = IngestStats()
+        self._queue = collections.deque()
+        # (guild, wizard, location) -> time accepted, oldest first
+        self._recent = collections.OrderedDict()
+        self._listeners = []
+
+    @property
+    def pending(self):
+        return len(self._queue)
+
+    def add_listener(self, listener):
+        """Calls ``listener(reports)`` on the event loop with each batch once it is committed."""
+        self._listeners.append(listener)
+
+    def _expire(self, now):
+        while self._recent:
+            key, accepted = next(iter(self._recent.items()))
+            if now - accepted < self.dedupe_window:
+                break
+            del self._recent[key]
+
+    def submit(self, guild_id, wizard_id, location_id, created=None):
+        """Queues a report, returns False if it duplicates a recent one."""
+        now = time.monotonic()
+        self._expire(now)
+        # location ids are only unique within a database partition
+        key = (guild_id, wizard_id, location_id)
+        if key in self._recent:
+            self.stats.duplicates += 1
+            return False
+        self._recent[key] = now
+        self._queue.append((guild_id, wizard_id, location_id, created or datetime.datetime.utcnow(), now, 0))
+        self.stats.accepted += 1
+        return True
+
+    @staticmethod
+    def _existing(batch):
+        # partitions don't enforce foreign keys, reports for deleted locations are rejected here
+        locations = set()
+        for ids in chunked({report[2] for report in batch}, LocationLoader.max_variables):
+            locations.update(location.id for location in
+                             LocationTable.select(LocationTable.id).where(LocationTable.id.in_(ids)))
+        return locations
+
+    @staticmethod
+    def _insert(batch):
+        rows = [(report[1], report[2], report[3]) for report in batch]
+        WizardReportRelation.insert_many(rows, fields=[WizardReportRelation.wizard,
+                                                       WizardReportRelation.location,
+                                                       WizardReportRelation.created]).execute()
+
+    @classmethod
+    def _write(cls, batch):
+        """Writes a batch in one statement, returns ``(written, rejected)``."""
+        locations = cls._existing(batch)
+        written = [report for report in batch if report[2] in locations]
+        if written:
+            cls._insert(written)
+        return written, [report for report in batch if report[2] not in locations]
+
+    @classmethod
+    def _write_each(cls, batch):
+        """Writes reports one at a time, returns ``(written, rejected, failed)``."""
+        locations = cls._existing(batch)
+        written, rejected, failed = [], [], []
+        for report in batch:
+            if report[2] not in locations:
+                rejected.append(report)
+                continue
+            try:
+                with DobbyDB._db.atomic():
+                    cls._insert([report])
+            except IntegrityError:
+                rejected.append(report)
+            except Exception:
+                failed.append(report)
+            else:
+                written.append(report)
+        return written, rejected, failed
+
+    def _retry(self, reports):
+        retry = []
+        for report in reports:
+            if report[5] + 1 >= self.max_attempts:
+                self.stats.dropped += 1
+                logger.error(f'Dropped report of location {report[2]} by {report[1]} '
+                             f'after {self.max_attempts} attempts')
+            else:
+                retry.append(report[:5] + (report[5] + 1,))
+        return retry
+
+    async def flush(self):
+        """Writes everything queued so far, returns the number of reports written."""
+        written = 0
+        retry = []
+        while self._queue:
+            batch = [self._queue.popleft() for __ in range(min(self.max_batch, len(self._queue)))]
+            groups = {}
+            for report in batch:
+                groups.setdefault(DobbyDB.guild(report[0]), []).append(report)
+            for database, reports in groups.items():
+                try:
+                    reports, rejected = await database.transaction(self._write, reports)
+                except Exception as e:
+                    self.stats.failed_batches += 1
+                    logger.error(f'Report batch of {len(reports)} failed, writing them one at a time: {e}')
+                    try:
+                        reports, rejected, failed = await database.transaction(self._write_each, reports)
+                    except Exception as e:
+                        logger.error(f'Writing reports one at a time failed: {e}')
+                        reports, rejected, failed = [], [], reports
+                    retry += self._retry(failed)
+                for report in rejected:
+                    logger.warning(f'Rejected report of location {report[2]} by {report[1]}, the location is gone')
+                self.stats.rejected += len(rejected)
+                if not reports:
+                    continue
+                now = time.monotonic()
+                self.stats.record(len(reports), [now - report[4] for report in reports])
+                written += len(reports)
+                for listener in self._listeners:
+                    listener(reports)
+        # failed reports go back in order and are tried again next time
+        self._queue.extendleft(reversed(retry))
+        return written
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
@@ -0,0 +1,833 @@
+import asyncio
+import copy
+import functools
+import json
+import logging
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+from collections.abc import Mapping, MutableMapping
+
+from peewee import chunked
+
+from dobby.exts.db.dobbydb import DobbyDB, GuildTable, LocationLoader, snowflake_keys
+
+logger = logging.getLogger('dobby')
+
+
+class PickleCodec:
+    name = 'pickle'
+
+    def encode(self, data):
+        return pickle.dumps(data, -1)
+
+    def decode(self, raw):
+        return pickle.loads(raw)
+
+
+class JSONCodec:
+    """Plain JSON, safe to load from untrusted files. Snowflake keys are
+    turned back into ints on decode."""
+    name = 'json'
+
+    def encode(self, data):
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, raw):
+        return json.loads(raw.decode('utf-8'), object_pairs_hook=snowflake_keys)
+
+
+class CompressedCodec:
+    """zlib compression on top of another codec."""
+
+    def __init__(self, codec, level=6):
+        self.codec = codec
+        self.level = level
+        self.name = f'{codec.name}.z'
+
+    def encode(self, data):
+        return zlib.compress(self.codec.encode(data), self.level)
+
+    def decode(self, raw):
+        return self.codec.decode(zlib.decompress(raw))
+
+
+CODECS = {codec.name: codec for codec in (PickleCodec(), JSONCodec(),
+                                          CompressedCodec(PickleCodec()), CompressedCodec(JSONCodec()))}
+
+
+def benchmark_codecs(guilds, codecs=None):
+    """Encodes and decodes every guild the way snapshots are written.
+
+    Returns a list of ``(codec name, encode seconds, decode seconds, bytes)``."""
+    results = []
+    for codec in (codecs or CODECS.values()):
+        encoded = []
+        start = time.perf_counter()
+        for data in guilds.values():
+            encoded.append(codec.encode(data))
+        encode_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for raw in encoded:
+            codec.decode(raw)
+        decode_time = time.perf_counter() - start
+        results.append((codec.name, encode_time, decode_time, sum(len(raw) for raw in encoded)))
+    return results
+
+
+class SnapshotStats:
+    """Timings for guild_dict saves.
+
+    ``pause`` is the time the event loop was blocked copying dirty guilds,
+    ``write`` is the time spent serializing and writing them in the executor."""
+
+    def __init__(self):
+        self.snapshots = 0
+        self.guilds_written = 0
+        self.last_pause = 0.0
+        self.max_pause = 0.0
+        self.total_pause = 0.0
+        self.last_write = 0.0
+
+    def record(self, pause, write, guilds):
+        self.snapshots += 1
+        self.guilds_written += guilds
+        self.last_pause = pause
+        self.max_pause = max(self.max_pause, pause)
+        self.total_pause += pause
+        self.last_write = write
+
+    @property
+    def average_pause(self):
+        return self.total_pause / self.snapshots if self.snapshots else 0.0
+
+
+_MISSING = object()
+
+
+def prune_defaults(value, default):
+    """Returns the parts of ``value`` that differ from ``default``.
+
+    Nested mappings are compared key by key. Returns ``_MISSING`` when nothing
+    differs."""
+    if isinstance(value, ConfigOverlay):
+        value = value.to_dict()
+    if not isinstance(value, Mapping) or not isinstance(default, Mapping):
+        return _MISSING if value == default else value
+    overrides = {}
+    for key, item in value.items():
+        item = prune_defaults(item, default[key]) if key in default else item
+        if item is not _MISSING:
+            overrides[key] = item
+    return overrides or _MISSING
+
+
+class ConfigOverlay(MutableMapping):
+    """A guild's config overrides layered on top of the shared default.
+
+    Reads fall through to ``default`` for anything the guild has not changed,
+    and writes store only values that differ from it. Nested default dicts are
+    returned as overlays themselves so writes into them land in the overrides.
+    Default lists are returned as copies, the shared default is never mutated.
+    ``on_change`` is called after every write."""
+
+    def __init__(self, overrides, default, on_change, parent=None, key=None):
+        self._overrides = overrides
+        self._default = default
+        self._on_change = on_change
+        self._parent = parent
+        self._key = key
+
+    def _writable(self):
+        if self._overrides is None:
+            self._overrides = {}
+            self._parent._writable()[self._key] = self._overrides
+        return self._overrides
+
+    def __getitem__(self, key):
+        default = self._default.get(key, _MISSING)
+        value = _MISSING if self._overrides is None else self._overrides.get(key, _MISSING)
+        if isinstance(default, Mapping) and (value is _MISSING or isinstance(value, dict)):
+            return ConfigOverlay(None if value is _MISSING else value, default, self._on_change, self, key)
+        if value is not _MISSING:
+            return value
+        if default is _MISSING:
+            raise KeyError(key)
+        if isinstance(default, list):
+            return list(default)
+        return default
+
+    def __setitem__(self, key, value):
+        if key in self._default:
+            value = prune_defaults(value, self._default[key])
+        elif isinstance(value, ConfigOverlay):
+            value = value.to_dict()
+        if value is _MISSING:
+            if self._overrides is None or key not in self._overrides:
+                return
+            del self._overrides[key]
+        else:
+            self._writable()[key] = value
+        self._on_change()
+
+    def __delitem__(self, key):
+        if self._overrides is None or key not in self._overrides:
+            raise KeyError(key)
+        del self._overrides[key]
+        self._on_change()
+
+    def __iter__(self):
+        keys = list(self._default)
+        if self._overrides is not None:
+            keys.extend(key for key in self._overrides if key not in self._default)
+        return iter(keys)
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __contains__(self, key):
+        return key in self._default or (self._overrides is not None and key in self._overrides)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.to_dict(), memo)
+
+    def __repr__(self):
+        return f'ConfigOverlay({self.to_dict()!r})'
+
+    def to_dict(self):
+        """Returns the full merged config as plain dicts."""
+        return {key: value.to_dict() if isinstance(value, ConfigOverlay) else value
+                for key, value in self.items()}
+
+
+class GuildDict(MutableMapping):
+    """guild_dict wrapper that remembers which guilds changed since the last save.
+
+    Assigning or deleting a guild is tracked automatically. Code that mutates a
+    guild's nested config in place has to call ``mark_dirty`` afterwards.
+    When the backing store is write-through, every change queues a write on
+    the store's own thread and the guild stays dirty until the latest one
+    succeeds, so a failed write is picked up by the next flush. Otherwise every
+    change is also appended to ``journal`` so it survives a crash before the
+    next save.
+
+    Only the store's index of guild ids is read up front. A guild's config is
+    loaded from the store the first time it is looked up, unless ``preload``
+    already read it off the event loop.
+
+    Each guild only keeps the keys that differ from ``defaults``; lookups
+    return a ConfigOverlay that reads through to the shared default and marks
+    the guild dirty whenever it is written to."""
+
+    def __init__(self, data=None, store=None, journal=None, defaults=None):
+        self._defaults = defaults or {}
+        self._data = {guild_id: self._prune(value) for guild_id, value in (data or {}).items()}
+        self._known = set(self._data)
+        if store is not None:
+            self._known.update(store.guild_ids())
+        self._dirty = set()
+        self._versions = {}
+        self._writes = set()
+        self._flush_lock = asyncio.Lock()
+        self._store = store
+        self.journal = journal
+        self.stats = SnapshotStats()
+
+    def _prune(self, value):
+        overrides = prune_defaults(value, self._defaults)
+        return {} if overrides is _MISSING else overrides
+
+    def _load(self, guild_id):
+        try:
+            return self._data[guild_id]
+        except KeyError:
+            if guild_id not in self._known or self._store is None:
+                raise
+        data = self._store.load(guild_id)
+        if data is None:
+            self._known.discard(guild_id)
+            raise KeyError(guild_id)
+        self._data[guild_id] = self._prune(data)
+        return self._data[guild_id]
+
+    async def preload(self, guild_ids=None, loop=None):
+        """Reads guilds that aren't loaded yet on the store's thread, all known guilds if none are given.
+
+        Lookups of a preloaded guild never touch the store from the event
+        loop. Returns the number of guilds loaded."""
+        if self._store is None:
+            return 0
+        missing = [guild_id for guild_id in (self._known if guild_ids is None else guild_ids)
+                   if guild_id in self._known and guild_id not in self._data]
+        if not missing:
+            return 0
+        loaded = await self._store.read(loop or asyncio.get_event_loop(), self._store.load_many, missing)
+        for guild_id, data in loaded.items():
+            # a guild changed or deleted while it was being read keeps that change
+            if guild_id in self._known and guild_id not in self._data:
+                self._data[guild_id] = self._prune(data)
+        return len(loaded)
+
+    def overrides(self, guild_id):
+        """Returns what is actually stored for a guild, without the defaults."""
+        return self._load(guild_id)
+
+    def __getitem__(self, guild_id):
+        return ConfigOverlay(self._load(guild_id), self._defaults,
+                             functools.partial(self.mark_dirty, guild_id))
+
+    def __setitem__(self, guild_id, value):
+        self._data[guild_id] = self._prune(value)
+        self._known.add(guild_id)
+        self._changed(guild_id)
+
+    def __delitem__(self, guild_id):
+        if guild_id not in self._known:
+            raise KeyError(guild_id)
+        self._data.pop(guild_id, None)
+        self._known.discard(guild_id)
+        self._dirty.discard(guild_id)
+        if self.journal is not None:
+            self.journal.append('delete', guild_id)
+        if self._store is None:
+            return
+        if not self._store.write_through:
+            self._store.delete(guild_id)
+            return
+        # a save still queued for the guild must not mark it clean afterwards
+        self._versions.pop(guild_id, None)
+        self._spawn(self._write(guild_id, None, self._store.delete, guild_id))
+
+    def __iter__(self):
+        return iter(list(self._known))
+
+    def __len__(self):
+        return len(self._known)
+
+    def __contains__(self, guild_id):
+        return guild_id in self._known
+
+    @property
+    def loaded(self):
+        return len(self._data)
+
+    def _changed(self, guild_id):
+        if self._store is None or not self._store.write_through:
+            self._dirty.add(guild_id)
+            if self.journal is not None:
+                self.journal.append('set', guild_id, self._data[guild_id])
+            return
+        self._dirty.add(guild_id)
+        version = self._versions[guild_id] = self._versions.get(guild_id, 0) + 1
+        data = copy.deepcopy(self._data[guild_id])
+        self._spawn(self._write(guild_id, version, self._store.save, guild_id, data))
+
+    async def _write(self, guild_id, version, fn, *args):
+        try:
+            await self._store.submit(asyncio.get_event_loop(), fn, *args)
+        except Exception as e:
+            logger.error(f'Guild config write failed for guild with id: {guild_id} - {e}')
+            return
+        if version is not None and self._versions.get(guild_id) == version:
+            self._dirty.discard(guild_id)
+
+    def _spawn(self, coro):
+        loop = asyncio.get_event_loop()
+        if not loop.is_running():
+            # nothing else is running yet, e.g. during startup, so just wait for it
+            loop.run_until_complete(coro)
+            return
+        task = loop.create_task(coro)
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    def mark_dirty(self, guild_id):
+        if guild_id in self._data:
+            self._changed(guild_id)
+
+    @property
+    def dirty(self):
+        return frozenset(self._dirty)
+
+    def pop_dirty(self):
+        """Returns the guild ids changed since the last call and resets tracking."""
+        dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def replay_journal(self):
+        """Applies journaled changes newer than the loaded snapshots.
+
+        Replayed guilds stay dirty so the next flush folds them into the
+        snapshots. Returns the number of records applied."""
+        if self.journal is None:
+            return 0
+        return self._apply(self.journal.replay())
+
+    def follow_journal(self):
+        """Applies records another process appended to the journal since the last call."""
+        if self.journal is None:
+            return 0
+        return self._apply(self.journal.follow())
+
+    async def invalidate(self, loop=None):
+        """Drops loaded guilds that have no unsaved changes and rereads the store's index.
+
+        Used when another process may have written to the store."""
+        if self._store is None:
+            return
+        guild_ids = await self._store.read(loop or asyncio.get_event_loop(), self._store.guild_ids)
+        self._data = {guild_id: data for guild_id, data in self._data.items() if guild_id in self._dirty}
+        self._known = set(guild_ids) | set(self._data)
+
+    def _apply(self, records):
+        applied = 0
+        for op, guild_id, data in records:
+            if op == 'set':
+                self._data[guild_id] = data
+                self._known.add(guild_id)
+                self._dirty.add(guild_id)
+            elif op == 'delete':
+                self._data.pop(guild_id, None)
+                self._known.discard(guild_id)
+                self._dirty.discard(guild_id)
+            applied += 1
+        return applied
+
+    async def flush(self, loop=None):
+        """Saves every dirty guild without serializing on the event loop.
+
+        The loop is only blocked while the journal is rotated and the dirty
+        guilds are copied; encoding, fsync and rename happen on the store's
+        thread. Write-through saves still queued are waited for first. Guilds
+        that fail to save are marked dirty again, which also journals them
+        again, so the rotated journal can always be dropped. Flushes run one
+        at a time, an overlapping one would rotate away the journal of the
+        guilds still being written. Returns ``(saved, skipped)``."""
+        async with self._flush_lock:
+            return await self._flush(loop or asyncio.get_event_loop())
+
+    async def _flush(self, loop):
+        if self._writes:
+            await asyncio.wait(list(self._writes))
+        start = time.perf_counter()
+        if self.journal is not None:
+            self.journal.rotate()
+        copies = {guild_id: copy.deepcopy(self._data[guild_id])
+                  for guild_id in self.pop_dirty() if guild_id in self._data}
+        pause = time.perf_counter() - start
+        start = time.perf_counter()
+        failed = await self._store.submit(loop, self._store.save_many, copies)
+        self.stats.record(pause, time.perf_counter() - start, len(copies) - len(failed))
+        for guild_id in failed:
+            self.mark_dirty(guild_id)
+        if self.journal is not None:
+            self.journal.discard_rotated()
+        return len(copies) - len(failed), len(self._known) - len(copies)
+
+
+class GuildJournal:
+    """Append-only log of guild_dict changes made between snapshots.
+
+    Each record is an encoded ``(op, guild_id, data)`` tuple tagged with its
+    codec name and framed by its length and crc32, so a record torn by a crash
+    is detected and replay stops there. ``rotate`` moves the live journal aside while a snapshot is written
+    and ``discard_rotated`` drops it once the snapshot is safely on disk."""
+
+    _header = struct.Struct('>II')
+
+    def __init__(self, path, codec=None):
+        self.path = path
+        self.rotated_path = path + '.old'
+        self.codec = codec or CODECS['pickle']
+        self._fd = open(self.path, 'ab')
+        self._tail = None
+
+    @property
+    def size(self):
+        return self._fd.tell()
+
+    def append(self, op, guild_id, data=None):
+        record = self.codec.name.encode() + b'\0' + self.codec.encode((op, guild_id, data))
+        self._fd.write(self._header.pack(len(record), zlib.crc32(record)) + record)
+        self._fd.flush()
+
+    def _decode(self, record):
+        name, __, payload = record.partition(b'\0')
+        return CODECS[name.decode()].decode(payload)
+
+    def _read_record(self, fd):
+        """Reads the next complete record, or returns None at a torn or missing one."""
+        header = fd.read(self._header.size)
+        if len(header) < self._header.size:
+            return None
+        length, crc = self._header.unpack(header)
+        record = fd.read(length)
+        if len(record) < length or zlib.crc32(record) != crc:
+            return None
+        return record
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as fd:
+                while True:
+                    start = fd.tell()
+                    record = self._read_record(fd)
+                    if record is None:
+                        if fd.tell() - start > self._header.size:
+                            logger.warning(f'Guild journal {path} is truncated, replay stopped early')
+                        return
+                    yield self._decode(record)
+        except OSError:
+            return
+
+    def follow(self):
+        """Yields records appended by another process since the last call.
+
+        A half-written record is left for the next call. When the writer
+        rotates the journal, the rest of the old file is read before switching
+        to the new one."""
+        while True:
+            if self._tail is None:
+                try:
+                    self._tail = open(self.path, 'rb')
+                except OSError:
+                    return
+            start = self._tail.tell()
+            record = self._read_record(self._tail)
+            if record is not None:
+                yield self._decode(record)
+                continue
+            self._tail.seek(start)
+            try:
+                rotated = os.stat(self.path).st_ino != os.fstat(self._tail.fileno()).st_ino
+            except OSError:
+                rotated = False
+            if not rotated:
+                return
+            self._tail.close()
+            self._tail = None
+
+    def reopen(self):
+        """Reopens the journal for appending, after another process rotated it."""
+        self._fd.close()
+        self._fd = open(self.path, 'ab')
+
+    def replay(self):
+        yield from self._read(self.rotated_path)
+        yield from self._read(self.path)
+
+    def rotate(self):
+        self._fd.close()
+        if os.path.exists(self.rotated_path):
+            # the last snapshot never finished, keep everything it still needs
+            with open(self.rotated_path, 'ab') as old, open(self.path, 'rb') as new:
+                shutil.copyfileobj(new, old)
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.rotated_path)
+        self._fd = open(self.path, 'ab')
+
+    def discard_rotated(self):
+        try:
+            os.remove(self.rotated_path)
+        except OSError:
+            pass
+
+    def close(self):
+        self._fd.close()
+        if self._tail is not None:
+            self._tail.close()
+
+
+class GuildSnapshotStore:
+    """Persists guild_dict as one snapshot per guild.
+
+    Every guild gets its own directory under ``path``, so a save cycle only
+    serializes the guild it is writing instead of the whole dict. A small
+    ``index`` file lists the stored guild ids so startup does not have to open
+    every snapshot.
+
+    Each save writes a new numbered generation named after its codec, framed
+    with a crc32 and fsynced before it is renamed into place. The newest
+    ``generations`` are kept. Loading walks them newest-first and returns the
+    first one that passes its checksum, giving up after ``load_timeout``
+    seconds rather than stalling on a damaged guild."""
+
+    _frame = struct.Struct('>4sII')
+    _magic = b'DGS1'
+
+    write_through = False
+
+    def __init__(self, path, legacy_path=None, codec=None, generations=3, load_timeout=5):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.codec = codec or CODECS['pickle']
+        self.generations = max(generations, 1)
+        self.load_timeout = load_timeout
+        self._index = None
+        self._index_lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def _guild_dir(self, guild_id):
+        return os.path.join(self.path, str(guild_id))
+
+    def _snapshots(self, guild_id):
+        """Returns ``(generation, path, codec)`` for every snapshot of a guild, newest first.
+
+        Unframed ``snapshot``/``snapshot_backup`` files from before generations
+        existed sort after every numbered generation."""
+        directory = self._guild_dir(guild_id)
+        try:
+            entries = os.listdir(directory)
+        except OSError:
+            return []
+        found = []
+        for entry in entries:
+            name, __, codec_name = entry.partition('.')
+            codec = CODECS.get(codec_name or 'pickle')
+            if codec is None:
+                continue
+            if name.isdigit():
+                found.append((int(name), os.path.join(directory, entry), codec))
+            elif name == 'snapshot':
+                found.append((-1, os.path.join(directory, entry), codec))
+            elif name == 'snapshot_backup':
+                found.append((-2, os.path.join(directory, entry), codec))
+        return sorted(found, key=lambda snapshot: snapshot[0], reverse=True)
+
+    def _unframe(self, raw):
+        if len(raw) < self._frame.size:
+            raise ValueError('snapshot is truncated')
+        magic, crc, length = self._frame.unpack_from(raw)
+        payload = raw[self._frame.size:]
+        if magic != self._magic or len(payload) != length or zlib.crc32(payload) != crc:
+            raise ValueError('snapshot checksum mismatch')
+        return payload
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.path, 'index'), 'rb') as fd:
+                return set(json.load(fd))
+        except (OSError, ValueError):
+            # missing or damaged index, rebuild it from the snapshot directories
+            index = {int(entry) for entry in os.listdir(self.path) if entry.isdigit()}
+            self._write_index(index)
+            return index
+
+    def _write_index(self, index):
+        with tempfile.NamedTemporaryFile('w', dir=self.path, delete=False) as tf:
+            json.dump(sorted(index), tf)
+            tf.flush()
+            os.fsync(tf.fileno())
+            tempname = tf.name
+        os.replace(tempname, os.path.join(self.path, 'index'))
+        _fsync_dir(self.path)
+
+    def _update_index(self, add=None, remove=None):
+        with self._index_lock:
+            if self._index is None:
+                self._index = self._read_index()
+            if add is not None and add not in self._index:
+                self._index.add(add)
+            elif remove is not None and remove in self._index:
+                self._index.discard(remove)
+            else:
+                return
+            self._write_index(self._index)
+
+    def guild_ids(self):
+        with self._index_lock:
+            if self._index is None:
+                self._index = self._read_index()
+            return list(self._index)
+
+    def load(self, guild_id):
+        deadline = time.monotonic() + self.load_timeout
+        for generation, path, codec in self._snapshots(guild_id):
+            if time.monotonic() > deadline:
+                logger.error(f'Gave up restoring guild with id: {guild_id} after {self.load_timeout}s')
+                break
+            try:
+                with open(path, 'rb') as fd:
+                    raw = fd.read()
+                if generation >= 0:
+                    raw = self._unframe(raw)
+                return codec.decode(raw)
+            except Exception as e:
+                logger.warning(f'Skipping damaged guild snapshot {path} - {e}')
+        return None
+
+    def load_many(self, guild_ids):
+        guild_dict = {}
+        for guild_id in guild_ids:
+            data = self.load(guild_id)
+            if data is not None:
+                guild_dict[guild_id] = data
+        return guild_dict
+
+    def load_all(self):
+        return self.load_many(self.guild_ids())
+
+    def save(self, guild_id, data):
+        directory = self._guild_dir(guild_id)
+        os.makedirs(directory, exist_ok=True)
+        snapshots = self._snapshots(guild_id)
+        generation = max(snapshots[0][0] + 1, 1) if snapshots else 1
+        payload = self.codec.encode(data)
+        with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as tf:
+            tf.write(self._frame.pack(self._magic, zlib.crc32(payload), len(payload)))
+            tf.write(payload)
+            tf.flush()
+            os.fsync(tf.fileno())
+            tempname = tf.name
+        os.replace(tempname, os.path.join(directory, f'{generation:08d}.{self.codec.name}'))
+        _fsync_dir(directory)
+        for __, path, __ in snapshots[self.generations - 1:]:
+            os.remove(path)
+        self._update_index(add=guild_id)
+
+    def save_many(self, snapshots):
+        return _save_many(self, snapshots)
+
+    def submit(self, loop, fn, *args):
+        return loop.run_in_executor(None, fn, *args)
+
+    def read(self, loop, fn, *args):
+        return loop.run_in_executor(None, fn, *args)
+
+    def delete(self, guild_id):
+        self._update_index(remove=guild_id)
+        shutil.rmtree(self._guild_dir(guild_id), ignore_errors=True)
+
+    def migrate_legacy(self):
+        """Splits a whole-dict ``serverdict`` pickle into per-guild snapshots.
+
+        Only runs while the store is still empty. The legacy file is renamed
+        afterwards so it is never read again. Returns the number of guilds migrated."""
+        if not self.legacy_path or self.guild_ids():
+            return 0
+        legacy = None
+        for path in (self.legacy_path, self.legacy_path + '_backup'):
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, 'rb') as fd:
+                    legacy = pickle.load(fd)
+                break
+            except Exception as e:
+                logger.warning(f'Unreadable legacy serverdict {path} - {e}')
+                continue
+        if legacy is None:
+            return 0
+        for guild_id, data in legacy.items():
+            self.save(guild_id, data)
+        for path in (self.legacy_path, self.legacy_path + '_backup'):
+            try:
+                os.replace(path, path + '.migrated')
+            except OSError:
+                pass
+        return len(legacy)
+
+
+class DatabaseGuildStore:
+    """Keeps each guild's config in ``GuildTable.config_dict``.
+
+    Saves are cheap single-row upserts, so guild_dict writes through on every
+    change instead of waiting for a periodic save. Writes are submitted to
+    the database thread like every other write, a second writer connection
+    on the event loop would only wait on its lock."""
+
+    write_through = True
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback
+
+    def guild_ids(self):
+        query = (GuildTable
+                 .select(GuildTable.snowflake)
+                 .where(GuildTable.config_dict.is_null(False)))
+        return [row.snowflake for row in query]
+
+    def load(self, guild_id):
+        row = (GuildTable
+               .select(GuildTable.config_dict)
+               .where(GuildTable.snowflake == guild_id)
+               .first())
+        return row.config_dict if row else None
+
+    def load_many(self, guild_ids):
+        guild_dict = {}
+        for batch in chunked(guild_ids, LocationLoader.max_variables):
+            query = (GuildTable
+                     .select(GuildTable.snowflake, GuildTable.config_dict)
+                     .where(GuildTable.snowflake.in_(batch) & GuildTable.config_dict.is_null(False)))
+            guild_dict.update((row.snowflake, row.config_dict) for row in query)
+        return guild_dict
+
+    def load_all(self):
+        query = (GuildTable
+                 .select(GuildTable.snowflake, GuildTable.config_dict)
+                 .where(GuildTable.config_dict.is_null(False)))
+        return {row.snowflake: row.config_dict for row in query}
+
+    def save(self, guild_id, data):
+        (GuildTable
+         .insert(snowflake=guild_id, config_dict=data)
+         .on_conflict(conflict_target=[GuildTable.snowflake],
+                      preserve=[GuildTable.config_dict])
+         .execute())
+
+    def save_many(self, snapshots):
+        return _save_many(self, snapshots)
+
+    def submit(self, loop, fn, *args):
+        return DobbyDB.run(fn, *args)
+
+    def read(self, loop, fn, *args):
+        return DobbyDB.read(fn, *args)
+
+    def delete(self, guild_id):
+        # the row itself stays, wizards, regions and locations reference it
+        GuildTable.update(config_dict=None).where(GuildTable.snowflake == guild_id).execute()
+
+    def migrate_legacy(self):
+        """Imports the snapshot store into the database the first time it is used."""
+        if self.fallback is None or self.guild_ids():
+            return 0
+        self.fallback.migrate_legacy()
+        legacy = self.fallback.load_all()
+        with DobbyDB._db.atomic():
+            for guild_id, data in legacy.items():
+                self.save(guild_id, data)
+        return len(legacy)
+
+
+def _save_many(store, snapshots):
+    failed = []
+    for guild_id, data in snapshots.items():
+        try:
+            store.save(guild_id, data)
+        except Exception as e:
+            logger.error(f'Server Dict Save - SAVING FAILED for guild with id: {guild_id} - {e}')
+            failed.append(guild_id)
+    return failed
+
+
+def _fsync_dir(path):
+    # make the rename itself durable; not every platform can open a directory
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -2,6 +2,7 @@
 
 import sys
 import os
+import signal
 import time
 import subprocess
 import argparse
@@ -19,49 +20,115 @@ def parse_cli_args():
         help=("Prevents output being sent to Discord DM, "
               "as restarting could occur often."),
         action="store_true")
+    parser.add_argument(
+        "--standby", "-s",
+        help=("Keeps a second Dobby process loaded and following guild state, "
+              "which takes over as soon as the running one exits or crashes. POSIX only."),
+        action="store_true")
     return parser.parse_args()
 
+def ready_file(child):
+    return os.path.join("data", "ready-{}".format(child.pid))
+
+def is_ready(child):
+    #a child writes its ready file once it has loaded and can take over
+    return child is not None and child.poll() is None and os.path.exists(ready_file(child))
+
+def stop_child(child):
+    if child is None:
+        return
+    if child.poll() is None:
+        child.terminate()
+        child.wait()
+    if os.path.exists(ready_file(child)):
+        os.remove(ready_file(child))
+
+def start_standby(cmd):
+    if not args.standby:
+        return None
+    return subprocess.Popen(cmd + ["standby"])
+
 def run_kyogre(autorestart):
     interpreter = sys.executable
     if interpreter is None:
         raise RuntimeError("Python could not be found")
 
     cmd = [interpreter, "-m", "dobby", "launcher"]
+    if args.debug:
+        cmd.append("debug")
 
     retries = 0
+    process = subprocess.Popen(cmd)
+    standby = None
+    standby_failures = 0
+    standby_died = 0
 
     while True:
-        if args.debug:
-            cmd.append("debug")
         try:
-            code = subprocess.call(cmd)
+            code = process.poll()
+            if code is None:
+                if standby is not None and standby.poll() is not None:
+                    #a standby that died is replaced, backing off like the primary does
+                    stop_child(standby)
+                    standby = None
+                    standby_failures += 1
+                    standby_died = time.time()
+                    print("Dobby standby exited, starting a new one")
+                elif is_ready(standby):
+                    standby_failures = 0
+                if is_ready(process):
+                    #the primary is up again, the next crash counts as the first
+                    retries = 0
+                    if standby is None and time.time() - standby_died >= min(standby_failures**2, 60):
+                        #only once the primary has migrated the database
+                        standby = start_standby(cmd)
+                time.sleep(0.5)
+                continue
         except KeyboardInterrupt:
             code = 0
             break
+        stop_child(process)
+        if code == 0:
+            break
+        if code == 26:
+            #standard restart, the standby may have loaded code that has been updated since
+            retries = 0
+            stop_child(standby)
+            standby = None
+            print("")
+            print("Restarting Dobby")
+            print("")
         else:
-            if code == 0:
+            if not autorestart:
                 break
-            elif code == 26:
-                #standard restart
-                retries = 0
-                print("")
-                print("Restarting Dobby")
-                print("")
-                continue
-            else:
-                if not autorestart:
-                    break
-                retries += 1
-                wait_time = min([retries^2, 60])
-                print("")
-                print("Dobby experienced a crash.")
-                print("")
-                for i in range(wait_time, 0, -1):
-                    sys.stdout.write("\r")
-                    sys.stdout.write(
-                        "Restarting Dobby from crash in {:0d}".format(i))
-                    sys.stdout.flush()
-                    time.sleep(1)
+            retries += 1
+            #the first crash is taken over by a ready standby straight away
+            wait_time = 0 if retries == 1 and is_ready(standby) else min([retries**2, 60])
+            print("")
+            print("Dobby experienced a crash.")
+            print("")
+            for i in range(wait_time, 0, -1):
+                sys.stdout.write("\r")
+                sys.stdout.write(
+                    "Restarting Dobby from crash in {:0d}".format(i))
+                sys.stdout.flush()
+                time.sleep(1)
+        if is_ready(standby):
+            #promote the warm standby instead of starting cold, it reports ready again once it has taken over
+            os.remove(ready_file(standby))
+            standby.send_signal(signal.SIGUSR1)
+            process = standby
+            print("")
+            print("Dobby standby promoted")
+            print("")
+        else:
+            #a standby still loading is started again once the new primary is ready
+            stop_child(standby)
+            process = subprocess.Popen(cmd)
+        standby = None
+
+    for child in (process, standby):
+        stop_child(child)
 
     print("Dobby has closed. Exit code: {exit_code}".format(exit_code=code))
 
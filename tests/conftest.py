@@ -0,0 +1,28 @@
+import asyncio
+import json
+import os
+import shutil
+
+import pytest
+
+from dobby.exts.db.dobbydb import DobbyDB
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+GUILD = 591447836684713994
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """A started DobbyDB on a fresh file, with the default data loaded."""
+    # the default data is loaded from the working directory
+    shutil.copytree(DATA, str(tmp_path / 'data'))
+    (tmp_path / 'config.json').write_text(json.dumps({'house_dict': {}, 'profession_dict': {}}))
+    monkeypatch.chdir(tmp_path)
+    DobbyDB.start(str(tmp_path / 'dobby.db'))
+    yield DobbyDB
+    DobbyDB.stop()
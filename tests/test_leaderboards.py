@@ -0,0 +1,47 @@
+import datetime
+
+from dobby.exts.db.dobbydb import (BadgeAssignmentTable, BadgeTable, LeaderboardTable, LocationTable,
+                                   WizardReportRelation)
+
+from tests.conftest import GUILD, run
+
+WHEN = datetime.datetime(2019, 7, 3, 12)
+
+
+def _totals(kind):
+    query = LeaderboardTable.select().where((LeaderboardTable.kind == kind) & (LeaderboardTable.guild == GUILD) &
+                                            (LeaderboardTable.total != 0))
+    return {(row.wizard, row.period, row.bucket): row.total for row in query}
+
+
+def test_report_triggers(database):
+    location = LocationTable.get((LocationTable.guild == GUILD) & (LocationTable.name == 'Burnett Linear Park'))
+    for wizard in (1, 1, 2):
+        WizardReportRelation.create(wizard=wizard, location=location, created=WHEN)
+    totals = _totals('reports')
+    assert totals[(1, 'day', '2019-07-03')] == 2
+    assert totals[(1, 'week', '2019-07-01')] == 2
+    assert totals[(2, 'all', '')] == 1
+    assert totals[(0, 'all', '')] == 3
+    WizardReportRelation.delete().where(WizardReportRelation.wizard == 1).execute()
+    assert _totals('reports') == {(wizard, period, bucket): 1 for wizard in (0, 2)
+                                  for period, bucket in (('day', '2019-07-03'), ('week', '2019-07-01'), ('all', ''))}
+    # the triggers agree with a full recount
+    totals = _totals('reports')
+    LeaderboardTable.rebuild()
+    assert _totals('reports') == totals
+
+
+def test_badge_triggers(database):
+    badge = BadgeTable.create(name='first', description='', emoji=1, active=True)
+    BadgeAssignmentTable.create(wizard=1, badge=badge, guild=GUILD, created=WHEN)
+    assert _totals('badges')[(1, 'all', '')] == 1
+    BadgeAssignmentTable.delete().execute()
+    assert _totals('badges') == {}
+
+
+def test_deleting_a_location_removes_its_reports_from_the_counts(database):
+    location = LocationTable.get((LocationTable.guild == GUILD) & (LocationTable.name == 'Burnett Linear Park'))
+    WizardReportRelation.create(wizard=1, location=location, created=WHEN)
+    run(database.transaction(LocationTable.delete_location, GUILD, 'inn', location.name))
+    assert _totals('reports') == {}
@@ -0,0 +1,15 @@
+import datetime
+
+from dobby.exts.db.dobbydb import LocationNoteTable, LocationTable, WizardReportRelation
+
+from tests.conftest import GUILD, run
+
+
+def test_delete_location_with_notes_and_reports(database):
+    location = LocationTable.get((LocationTable.guild == GUILD) & (LocationTable.name == 'Burnett Linear Park'))
+    LocationNoteTable.create(location=location, note='by the fountain')
+    WizardReportRelation.create(wizard=1, location=location, created=datetime.datetime.utcnow())
+    deleted = run(database.transaction(LocationTable.delete_location, GUILD, 'inn', location.name))
+    assert deleted == 3
+    assert not LocationTable.select().where(LocationTable.id == location.id).exists()
+    assert not LocationNoteTable.select().where(LocationNoteTable.location == location.id).exists()
@@ -0,0 +1,59 @@
+import io
+import json
+
+import pytest
+
+from dobby.locimport import LocationImportError, read_csv, read_geojson, validate
+
+REGIONS = {'renton', 'kent'}
+
+
+def test_read_csv():
+    fd = io.StringIO('Type,Name,Region,Latitude,Longitude,Notes\n'
+                     'inn, Burnett Park ,renton,47.47,-122.2,by the fountain|north gate\n')
+    assert list(read_csv(fd)) == [(2, {'type': 'inn', 'name': 'Burnett Park', 'region': 'renton',
+                                       'latitude': '47.47', 'longitude': '-122.2',
+                                       'notes': ['by the fountain', 'north gate']})]
+
+
+def test_read_csv_missing_columns():
+    with pytest.raises(LocationImportError, match='latitude, longitude'):
+        list(read_csv(io.StringIO('type,name,region\ninn,a,renton\n')))
+
+
+def test_read_geojson():
+    features = [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [-122.2, 47.47]},
+                 'properties': {'Type': 'fortress', 'Name': 'Park', 'Region': 'renton', 'notes': 'gate'}}]
+    fd = io.StringIO(json.dumps({'type': 'FeatureCollection', 'features': features}))
+    # a small chunk size makes the scanner stitch the feature together across reads
+    assert list(read_geojson(fd, chunk_size=7)) == [(1, {'type': 'fortress', 'name': 'Park', 'region': 'renton',
+                                                         'notes': ['gate'], 'longitude': -122.2,
+                                                         'latitude': 47.47})]
+
+
+def test_read_geojson_truncated():
+    with pytest.raises(LocationImportError):
+        list(read_geojson(io.StringIO('{"features": [{"type": "Feature"')))
+
+
+def test_validate():
+    fields = {'type': 'Inn', 'name': 'Park', 'region': 'Renton|kent', 'latitude': '47.47', 'longitude': '-122.2',
+              'notes': ['gate']}
+    assert validate(fields, REGIONS, set()) == ('Park', {'coordinates': '47.47,-122.2', 'region': 'renton,kent',
+                                                         'notes': ['gate']}, 'inn')
+
+
+@pytest.mark.parametrize('fields, error', [
+    ({'type': 'tower'}, 'unknown type'),
+    ({'name': ''}, 'missing name'),
+    ({'name': 'Existing'}, 'already exists'),
+    ({'region': 'seattle'}, 'unknown region'),
+    ({'region': ''}, 'unknown region'),
+    ({'latitude': 'north'}, 'not numbers'),
+    ({'latitude': '91'}, 'out of range'),
+])
+def test_validate_rejects(fields, error):
+    row = dict({'type': 'inn', 'name': 'Park', 'region': 'renton', 'latitude': '47.47', 'longitude': '-122.2'},
+               **fields)
+    with pytest.raises(ValueError, match=error):
+        validate(row, REGIONS, {'existing'})
@@ -0,0 +1,9 @@
+from dobby.exts.badges import Badges
+from dobby.exts.eventcommands import EventCommands
+from dobby.exts.locationmatching import LocationMatching
+
+
+def test_templates_use_indexes(database):
+    for cog in (LocationMatching, EventCommands, Badges):
+        cog(None)
+    assert database.queries.full_scans() == []
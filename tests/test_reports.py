@@ -0,0 +1,56 @@
+from peewee import OperationalError
+
+from dobby.exts.db.dobbydb import LocationTable, WizardReportRelation
+from dobby.reports import ReportIngestor
+
+from tests.conftest import GUILD, run
+
+
+def _locations():
+    return [location.id for location in LocationTable.select().where(LocationTable.guild == GUILD).limit(2)]
+
+
+def test_dedupe():
+    ingestor = ReportIngestor(dedupe_window=300)
+    assert ingestor.submit(GUILD, 1, 10)
+    assert not ingestor.submit(GUILD, 1, 10)
+    assert ingestor.submit(GUILD, 2, 10)
+    assert ingestor.submit(GUILD, 1, 11)
+    assert (ingestor.stats.accepted, ingestor.stats.duplicates, ingestor.pending) == (3, 1, 3)
+    ingestor = ReportIngestor(dedupe_window=0)
+    assert ingestor.submit(GUILD, 1, 10)
+    assert ingestor.submit(GUILD, 1, 10)
+
+
+def test_flush_writes_and_rejects(database):
+    first, second = _locations()
+    ingestor = ReportIngestor()
+    batches = []
+    ingestor.add_listener(batches.append)
+    ingestor.submit(GUILD, 1, first)
+    ingestor.submit(GUILD, 1, 99999999)
+    ingestor.submit(GUILD, 2, second)
+    assert run(ingestor.flush()) == 2
+    assert [report[2] for batch in batches for report in batch] == [first, second]
+    assert (ingestor.stats.rejected, ingestor.pending) == (1, 0)
+    assert WizardReportRelation.select().count() == 2
+
+
+def test_flush_retries_then_drops(database, monkeypatch):
+    first, second = _locations()
+    insert = ReportIngestor._insert
+
+    def failing(batch):
+        if any(report[2] == first for report in batch):
+            raise OperationalError('disk I/O error')
+        insert(batch)
+    monkeypatch.setattr(ReportIngestor, '_insert', staticmethod(failing))
+    ingestor = ReportIngestor(max_attempts=2)
+    ingestor.submit(GUILD, 1, first)
+    ingestor.submit(GUILD, 2, second)
+    # the failing report doesn't hold up the one behind it
+    assert run(ingestor.flush()) == 1
+    assert ingestor.pending == 1
+    assert run(ingestor.flush()) == 0
+    assert (ingestor.pending, ingestor.stats.dropped) == (0, 1)
+    assert [report.location_id for report in WizardReportRelation.select()] == [second]
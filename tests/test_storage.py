@@ -0,0 +1,130 @@
+from dobby.storage import GuildDict, GuildJournal, GuildSnapshotStore, prune_defaults
+
+from tests.conftest import run
+
+
+def _open(path):
+    store = GuildSnapshotStore(str(path / 'guilds'))
+    journal = GuildJournal(str(path / 'guilds' / 'journal'))
+    return store, journal, GuildDict(store=store, journal=journal)
+
+
+def test_journal_replay_after_crash(tmp_path):
+    store, journal, guild_dict = _open(tmp_path)
+    guild_dict[1] = {'prefix': '?'}
+    guild_dict[2] = {'prefix': '!'}
+    del guild_dict[2]
+    # the process dies without flushing
+    journal.close()
+    store, journal, guild_dict = _open(tmp_path)
+    assert guild_dict.replay_journal() == 3
+    assert guild_dict.overrides(1) == {'prefix': '?'}
+    assert 2 not in guild_dict
+    assert guild_dict.dirty == {1}
+    journal.close()
+
+
+def test_journal_replay_after_flush(tmp_path):
+    store, journal, guild_dict = _open(tmp_path)
+    guild_dict[1] = {'prefix': '?'}
+    run(guild_dict.flush())
+    guild_dict[2] = {'prefix': '!'}
+    journal.close()
+    store, journal, guild_dict = _open(tmp_path)
+    # only the change made since the snapshot is left in the journal
+    assert guild_dict.replay_journal() == 1
+    assert guild_dict.overrides(1) == {'prefix': '?'}
+    assert guild_dict.overrides(2) == {'prefix': '!'}
+    journal.close()
+
+
+def test_journal_replay_stops_at_torn_record(tmp_path):
+    journal = GuildJournal(str(tmp_path / 'journal'))
+    journal.append('set', 1, {'prefix': '?'})
+    journal.append('set', 2, {'prefix': '!'})
+    journal.close()
+    with open(tmp_path / 'journal', 'rb+') as fd:
+        fd.truncate(fd.seek(0, 2) - 3)
+    journal = GuildJournal(str(tmp_path / 'journal'))
+    assert list(journal.replay()) == [('set', 1, {'prefix': '?'})]
+    journal.close()
+
+
+def test_journal_replay_stops_at_bad_checksum(tmp_path):
+    journal = GuildJournal(str(tmp_path / 'journal'))
+    journal.append('set', 1, {'prefix': '?'})
+    size = journal.size
+    journal.append('set', 2, {'prefix': '!'})
+    journal.append('set', 3, {'prefix': '$'})
+    journal.close()
+    with open(tmp_path / 'journal', 'rb+') as fd:
+        fd.seek(size + 12)
+        byte = fd.read(1)
+        fd.seek(size + 12)
+        fd.write(bytes([byte[0] ^ 0xff]))
+    journal = GuildJournal(str(tmp_path / 'journal'))
+    assert list(journal.replay()) == [('set', 1, {'prefix': '?'})]
+    journal.close()
+
+
+def test_snapshot_falls_back_to_older_generation(tmp_path):
+    store = GuildSnapshotStore(str(tmp_path), generations=3)
+    store.save(1, {'prefix': '?'})
+    store.save(1, {'prefix': '!'})
+    newest = store._snapshots(1)[0][1]
+    with open(newest, 'rb+') as fd:
+        fd.seek(-1, 2)
+        fd.write(b'\0')
+    assert store.load(1) == {'prefix': '?'}
+
+
+def test_snapshot_keeps_generations(tmp_path):
+    store = GuildSnapshotStore(str(tmp_path), generations=2)
+    for prefix in '?!$':
+        store.save(1, {'prefix': prefix})
+    assert [generation for generation, __, __ in store._snapshots(1)] == [3, 2]
+    assert store.load(1) == {'prefix': '$'}
+
+
+def test_snapshot_every_generation_damaged(tmp_path):
+    store = GuildSnapshotStore(str(tmp_path))
+    store.save(1, {'prefix': '?'})
+    with open(store._snapshots(1)[0][1], 'wb') as fd:
+        fd.write(b'DGS1')
+    assert store.load(1) is None
+
+
+DEFAULTS = {'configure_dict': {'settings': {'prefix': None, 'offset': 0, 'config_sessions': {}},
+                               'house': {'enabled': False, 'sort_channels': []}}}
+
+
+def test_prune_defaults():
+    value = {'configure_dict': {'settings': {'prefix': '?', 'offset': 0},
+                                'house': {'enabled': False, 'sort_channels': []}},
+             'custom': 1}
+    assert prune_defaults(value, DEFAULTS) == {'configure_dict': {'settings': {'prefix': '?'}}, 'custom': 1}
+
+
+def test_overlay_stores_only_overrides():
+    guild_dict = GuildDict(data={1: {}}, defaults=DEFAULTS)
+    guild_dict.pop_dirty()
+    settings = guild_dict[1]['configure_dict']['settings']
+    assert settings['offset'] == 0
+    settings['prefix'] = '?'
+    settings['config_sessions'][42] = 1
+    assert guild_dict.dirty == {1}
+    assert guild_dict.overrides(1) == {'configure_dict': {'settings': {'prefix': '?', 'config_sessions': {42: 1}}}}
+    # setting a value back to its default drops the override
+    settings['prefix'] = None
+    del settings['config_sessions'][42]
+    assert 'prefix' not in guild_dict.overrides(1)['configure_dict']['settings']
+    assert settings.to_dict() == DEFAULTS['configure_dict']['settings']
+
+
+def test_overlay_never_mutates_the_default():
+    guild_dict = GuildDict(data={1: {}, 2: {}}, defaults=DEFAULTS)
+    guild_dict[1]['configure_dict']['house']['sort_channels'].append(5)
+    guild_dict[1]['configure_dict']['house'] = {'enabled': True, 'sort_channels': [5]}
+    assert DEFAULTS['configure_dict']['house'] == {'enabled': False, 'sort_channels': []}
+    assert guild_dict[2]['configure_dict']['house']['sort_channels'] == []
+    assert guild_dict[1]['configure_dict']['house'].to_dict() == {'enabled': True, 'sort_channels': [5]}